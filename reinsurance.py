@@ -1,30 +1,117 @@
-from dash import Dash, dcc, html, Input, Output, State, ctx
+import gzip
+import json
+import operator
+import os
+
+from dash import Dash, DiskcacheManager, dcc, html, Input, Output, State, ctx
 import dash_daq as daq 
-from pal import config, XoLTower, distributions
-from pal.frequency_severity import FrequencySeverityModel
+from flask import request
 import numpy as np
 import plotly.graph_objs as go
+import plotly.io as pio
 from dash import dash_table
+from reinsurance_engine import (
+    PIE_BUCKET_LABELS, SimulationParams, analytic_preview, run_simulation, share_simulation_caches
+)
 
 app = Dash(__name__, suppress_callback_exceptions=True)
 
+# Background job mode: set REINSURANCE_BACKGROUND_JOBS=1 to run simulations in a
+# separate process managed by diskcache (pip install "dash[diskcache]"), so web
+# workers stay free and a resubmitted run kills the one it replaces. Each job is a
+# new process, so the simulation caches move to a diskcache directory next to the
+# jobs' to outlive it, and running on all CPU cores is turned off: every job would
+# start its own pool of worker processes.
+background_callback_manager = None
+if os.environ.get('REINSURANCE_BACKGROUND_JOBS') == '1':
+    import diskcache
+    job_cache_directory = os.environ.get('REINSURANCE_JOB_CACHE', './cache')
+    background_callback_manager = DiskcacheManager(diskcache.Cache(job_cache_directory))
+    share_simulation_caches(os.path.join(job_cache_directory, 'simulations'))
+
+# Gzip callback responses (figure data compresses well) for clients that accept it.
+# Set REINSURANCE_GZIP=0 to turn this off, e.g. behind a proxy that already compresses
+GZIP_MIN_BYTES = 1024
+if os.environ.get('REINSURANCE_GZIP', '1') == '1':
+    @app.server.after_request
+    def gzip_response(response):
+        if (response.direct_passthrough
+                or response.status_code != 200
+                or 'Content-Encoding' in response.headers
+                or 'gzip' not in request.headers.get('Accept-Encoding', '')
+                or response.mimetype != 'application/json'):
+            return response
+        data = response.get_data()
+        if len(data) < GZIP_MIN_BYTES:
+            return response
+        response.set_data(gzip.compress(data, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Content-Length'] = str(len(response.get_data()))
+        response.vary.add('Accept-Encoding')
+        return response
+
 THEMES = {
     "dark": {
         "background": "#181A1B",
         "card": "#23272E",
         "text": "#F5F6FA",
         "primary": "#859EFF",
-        "border": "#444"
+        "border": "#444",
+        "page": "#181A1B",
+        "loading": "#F5F6FA",
+        "muted": "#aaa"
     },
     "light": {
         "background": "#F5F6FA",
         "card": "#FFFFFF",
         "text": "#23272E",
         "primary": "#3B4CCA",
-        "border": "#CCC"
+        "border": "#CCC",
+        "page": "#FFFFFF",
+        "loading": "#000000",
+        "muted": "#FFFFFF"
     }
 }
 
+# Theme colours as CSS custom properties. Page layouts use THEME_COLORS and the
+# page root carries a theme-<name> class, so switching theme only swaps that class
+# in the browser and the layouts themselves never change
+THEME_COLORS = {name: f"var(--theme-{name})" for name in THEMES["dark"]}
+
+def theme_css():
+    rules = []
+    for theme_name, theme_colors in THEMES.items():
+        properties = " ".join(f"--theme-{name}: {value};" for name, value in theme_colors.items())
+        rules.append(f".theme-{theme_name} {{ {properties} }}")
+    return "\n".join(rules)
+
+app.index_string = app.index_string.replace(
+    "{%css%}", "{%css%}\n        <style>\n" + theme_css() + "\n        </style>"
+)
+
+# Plotly figure template for a theme: the theme's card background and text colour
+# on the plot, axes and legend. Built from scratch rather than on the "plotly"
+# template, since importing pal switches plotly's default template to "none".
+def figure_template(colors):
+    template = go.layout.Template()
+    axis = dict(linecolor=colors["text"], gridcolor=colors["text"])
+    template.layout.update(
+        plot_bgcolor=colors["card"],
+        paper_bgcolor=colors["card"],
+        font=dict(color=colors["text"]),
+        legend=dict(font=dict(color=colors["text"])),
+        xaxis=axis,
+        yaxis=axis,
+        margin=dict(l=40, r=40, t=40, b=40)
+    )
+    return template
+
+# Templates are registered once at import and figures refer to them by name
+FIGURE_TEMPLATES = {}
+for theme_name, theme_colors in THEMES.items():
+    FIGURE_TEMPLATES[theme_name] = f"reinsurance_{theme_name}"
+    pio.templates[FIGURE_TEMPLATES[theme_name]] = figure_template(theme_colors)
+
 # Store to keep track of which card is full screen
 fullscreen_store = dcc.Store(id='home-fullscreen-card', data=None)
 
@@ -51,10 +138,10 @@ def fullscreen_button(card_id):
         }
     )
 
-def home_page(theme="dark", fullscreen_card=None):
-    colors = THEMES[theme]
-    text_color = "#23272E" if theme == "light" else colors["text"]
-    primary_color = colors["primary"] if theme == "dark" else "#3B4CCA"
+def home_page(fullscreen_card=None):
+    colors = THEME_COLORS
+    text_color = colors["text"]
+    primary_color = colors["primary"]
     card_bg = colors["card"]
     bg_color = colors["background"]
 
@@ -250,11 +337,18 @@ def tooltip_icon(id, text):
         }
     )
 
+# Stages reported to the progress bar while a submit is running
+SIMULATION_STAGES = [
+    "Simulating losses",
+    "Applying reinsurance tower",
+    "Sweeping limit and excess",
+    "Building figures",
+]
+
 # Main app page: user input & graphs
-def main_app_page(theme="dark"):
-    colors = THEMES[theme]
-    loading_color = "#000000" if theme == "light" else "#F5F6FA"
-    graph_outline = "#23272E" if theme == "light" else "#FFFFFF"
+def main_app_page():
+    colors = THEME_COLORS
+    loading_color = colors["loading"]
     responsive_css = dcc.Markdown(
         """
         <style>
@@ -532,6 +626,7 @@ def main_app_page(theme="dark"):
                             ),
                             html.Div(
                                 "Example: 100,000 (recommended)",
+                                id='sim-recommend-msg',
                                 style={'color': '#aaa', 'fontSize': '0.95em', 'marginBottom': '10px'}
                             )
                         ]),
@@ -612,6 +707,57 @@ def main_app_page(theme="dark"):
                             value=[],
                             style={'marginBottom': '10px', 'color': colors["text"]}
                         )
+                    ]),
+                    html.Label([
+                        dcc.Checklist(
+                            id='simulation-options',
+                            options=[
+                                {'label': ' Stream simulations in chunks (for very large runs)', 'value': 'stream'},
+                                {'label': ' Run simulations on all CPU cores', 'value': 'parallel'},
+                                {'label': ' Log-scale histogram bins (heavy tails)', 'value': 'log-bins'},
+                                {'label': ' Cross-check against the analytic model', 'value': 'cross-check'},
+                                {'label': ' Stop once the estimates are precise enough (simulations become the maximum)',
+                                 'value': 'adaptive'},
+                            ],
+                            value=[],
+                            style={'marginBottom': '10px', 'color': colors["text"]}
+                        )
+                    ]),
+                    html.Div([
+                        html.Label([
+                            'Tolerance (%)',
+                            tooltip_icon('tooltip-tolerance', 'With the stop option, simulation stops once the standard errors of the mean and 99th percentile are within this percentage of their values. Monte Carlo simulation only, without streaming or all CPU cores.')
+                        ], style={'color': colors["text"]}),
+                        dcc.Input(
+                            id='input-tolerance',
+                            type='number',
+                            placeholder='Tolerance (%)',
+                            value=1,
+                            min=0.01,
+                            step=0.1,
+                            style={
+                                'width': '100%',
+                                'backgroundColor': colors["card"],
+                                'color': colors["text"],
+                                'border': f'1px solid {colors["border"]}',
+                                'marginBottom': '10px',
+                                'fontSize': '1.1em'
+                            }
+                        ),
+                    ]),
+                    html.Label([
+                        dcc.RadioItems(
+                            id='simulation-method',
+                            options=[
+                                {'label': ' Monte Carlo simulation', 'value': 'simulation'},
+                                {'label': ' Exact distribution via FFT (no sampling noise)', 'value': 'fft'},
+                                {'label': ' Simulate only years that reach the layer (importance sampling, sharper tail)',
+                                 'value': 'importance'},
+                                {'label': ' Quasi-Monte Carlo (scrambled Sobol, with standard errors)', 'value': 'sobol'},
+                            ],
+                            value='simulation',
+                            style={'marginBottom': '10px', 'color': colors["text"]}
+                        )
                     ])
                 ], style={'marginTop': '18px'}),
                 html.Button(
@@ -627,6 +773,23 @@ def main_app_page(theme="dark"):
                     },
                     disabled=False
                 ),
+                html.Div([
+                    html.Progress(id='simulation-progress', value='0', max=str(len(SIMULATION_STAGES)), style={'width': '100%'}),
+                    html.Div(id='simulation-progress-label', style={'color': colors["text"], 'fontSize': '0.95em'}),
+                    html.Button(
+                        'Cancel',
+                        id='cancel-val',
+                        n_clicks=0,
+                        style={
+                            'marginTop': '8px',
+                            'width': '100%',
+                            'backgroundColor': '#444',
+                            'color': '#F5F6FA',
+                            'border': 'none'
+                        }
+                    )
+                ], id='simulation-progress-container', style={'marginTop': '12px', 'display': 'none'}),
+                html.Div(id='analytic-preview', style={'marginTop': '12px', 'color': colors["text"], 'fontSize': '0.95em'}),
                 dcc.Loading(
                     id="loading",
                     type="default",
@@ -717,11 +880,11 @@ def main_app_page(theme="dark"):
     ])
 
 # More Info page: external resources
-def more_info_page(theme="dark"):
-    colors = THEMES[theme]
+def more_info_page():
+    colors = THEME_COLORS
     card_bg = colors["card"]
-    text_color = "#23272E" if theme == "light" else colors["text"]
-    bg_color = "#FFFFFF" if theme == "light" else "#181A1B"
+    text_color = colors["text"]
+    bg_color = colors["page"]
 
     def card_text(text):
         if len(text) > 35:
@@ -1183,7 +1346,7 @@ def more_info_page(theme="dark"):
                 'fontSize': '2.2em',
                 'textAlign': 'center',
                 'marginBottom': '24px',
-                'color': colors["primary"] if theme == "dark" else "#3B4CCA"
+                'color': colors["primary"]
             }
         ),
         html.Div([
@@ -1263,8 +1426,9 @@ navbar = html.Div([
                 style={
                     'marginTop': '8px',
                     'fontSize': '0.95em',
-                    'color': '#aaa',
-                    'textAlign': 'center'
+                    'color': THEME_COLORS["muted"],
+                    'textAlign': 'center',
+                    'display': 'block'
                 }
             )
         ],
@@ -1279,13 +1443,24 @@ navbar = html.Div([
     'justifyContent': 'space-between'
 })
 
+# Every page is built once and mounted at start-up. Switching tabs only toggles
+# which one is visible, so there is no server work and inputs and results are kept
+PAGES = {'home': home_page, 'main': main_app_page, 'moreinfo': more_info_page}
+
+def page_container(tab, build_page):
+    return html.Div(build_page(), id=f'page-{tab}', style={'display': 'block' if tab == 'home' else 'none'})
+
 # App main layout with theme support
 app.layout = html.Div([
     navbar,
     dcc.Store(id='theme-store', data='dark'),
-    html.Div(id='page-content')
-], id='main-app-bg', style={
-    'backgroundColor': THEMES["dark"]["background"],
+    dcc.Store(id='figure-templates', data={
+        theme_name: pio.templates[template_name].to_plotly_json()
+        for theme_name, template_name in FIGURE_TEMPLATES.items()
+    }),
+    html.Div([page_container(tab, build_page) for tab, build_page in PAGES.items()], id='page-content')
+], id='main-app-bg', className='theme-dark', style={
+    'backgroundColor': THEME_COLORS["background"],
     'minHeight': '100vh',
     'height': '100vh',
     'margin': 0,
@@ -1293,20 +1468,16 @@ app.layout = html.Div([
     'boxSizing': 'border-box'
 })
 
-# Update the main background color when theme changes
-@app.callback(
-    Output('main-app-bg', 'style'),
+# Switch the theme class on the page root in the browser when the theme changes
+app.clientside_callback(
+    """
+    function(theme) {
+        return 'theme-' + theme;
+    }
+    """,
+    Output('main-app-bg', 'className'),
     Input('theme-store', 'data')
 )
-def update_main_bg(theme):
-    return {
-        'backgroundColor': THEMES[theme]["background"],
-        'minHeight': '100vh',
-        'height': '100vh',
-        'margin': 0,
-        'padding': 0,
-        'boxSizing': 'border-box'
-    }
 
 # Theme toggle callback
 @app.callback(
@@ -1316,84 +1487,124 @@ def update_main_bg(theme):
 def update_theme(is_light):
     return 'light' if is_light else 'dark'
 
-# Callback to update the dark mode message color for visibility
-@app.callback(
-    Output('dark-mode-msg', 'style'),
-    Input('theme-store', 'data')
-)
-def update_dark_mode_msg(theme):
-    return {
-        'marginTop': '8px',
-        'fontSize': '0.95em',
-        'color': "#FFFFFF" if theme == 'light' else '#aaa',
-        'textAlign': 'center',
-        'display': 'block'
+# Show the page for the selected tab and hide the others, in the browser
+app.clientside_callback(
+    """
+    function(tab) {
+        var tabs = %s;
+        if (tabs.indexOf(tab) < 0) {
+            tab = 'home';
+        }
+        return tabs.map(function(name) {
+            return {'display': name === tab ? 'block' : 'none'};
+        });
     }
-
-# Page navigation callback with theme
-@app.callback(
-    Output('page-content', 'children'),
-    Input('page-tabs', 'value'),
-    Input('theme-store', 'data')
+    """ % json.dumps(list(PAGES)),
+    [Output(f'page-{tab}', 'style') for tab in PAGES],
+    Input('page-tabs', 'value')
 )
-def render_page(tab, theme):
-    if tab == 'home':
-        return home_page(theme)
-    elif tab == 'main':
-        return main_app_page(theme)
-    elif tab == 'moreinfo':
-        return more_info_page(theme)
-    return home_page(theme)
 
-# Show/hide policy limit warning based on input changes
-@app.callback(
-    Output('policy-limit-warning', 'style'),
-    Input('input-policy-limit', 'value'),
-    Input('input-excess', 'value'),
-)
-def show_policy_limit_warning(policy_limit, excess):
-    try:
-        if policy_limit is not None and excess is not None and float(policy_limit) < float(excess):
-            return {'color': '#ffb347', 'fontSize': '0.95em', 'marginBottom': '10px', 'display': 'block'}
-    except Exception:
-        pass
-    return {'display': 'none'}
+# Rules between the contract inputs, shared by the warnings shown while typing
+# (checked in the browser) and the checks made on submit. A rule is broken when
+# "left op right" holds; blocking rules also stop the simulation with their message.
+INPUT_RULES = [
+    {'warning': 'aggregate-limit-warning', 'left': 'aggregate-limit', 'op': '<', 'right': 'limit',
+     'blocking': True, 'message': "Aggregate limit must be greater than or equal to limit."},
+    {'warning': 'aggregate-deductible-warning', 'left': 'aggregate-deductible', 'op': '<=', 'right': 'excess',
+     'blocking': True, 'message': "Aggregate deductible must be greater than the excess as it is for a year rather than just one claim."},
+    {'warning': 'policy-limit-warning', 'left': 'policy-limit', 'op': '<', 'right': 'excess', 'blocking': False},
+    {'warning': 'limit-excess-warning', 'left': 'limit', 'op': '<', 'right': 'excess', 'blocking': False},
+]
+INPUT_RULE_FIELDS = ['limit', 'aggregate-limit', 'policy-limit', 'excess', 'aggregate-deductible']
+INPUT_RULE_OPERATORS = {'<': operator.lt, '<=': operator.le}
+WARNING_STYLE = {'color': '#ffb347', 'fontSize': '0.95em', 'marginBottom': '10px', 'display': 'block'}
 
-# Show/hide aggregate deductible warning as user is typing
-@app.callback(
-    Output('aggregate-deductible-warning', 'style'),
-    Input('input-excess', 'value'),
-    Input('input-aggregate-deductible', 'value'),
-)
-def show_aggregate_deductible_warning(excess, aggregate_deductible):
-    try:
-        if aggregate_deductible is not None and excess is not None and float(aggregate_deductible) <= float(excess):
-            return {'color': '#ffb347', 'fontSize': '0.95em', 'marginBottom': '10px', 'display': 'block'}
-    except Exception:
-        pass
-    return {'display': 'none'}
+# Rules broken by a dict of field name -> number (missing fields break nothing)
+def broken_input_rules(values):
+    broken = []
+    for rule in INPUT_RULES:
+        left, right = values.get(rule['left']), values.get(rule['right'])
+        if left is not None and right is not None and INPUT_RULE_OPERATORS[rule['op']](left, right):
+            broken.append(rule)
+    return broken
 
-# Show/hide limit-excess warning as user is typing
-@app.callback(
-    Output('limit-excess-warning', 'style'),
-    Input('input-limit', 'value'),
-    Input('input-excess', 'value'),
+# Message of the first blocking rule the contract in params breaks, if any
+def blocking_rule_message(params):
+    for rule in broken_input_rules({
+        'limit': params.limit, 'aggregate-limit': params.aggregate_limit, 'policy-limit': params.policy_limit,
+        'excess': params.excess, 'aggregate-deductible': params.aggregate_deductible
+    }):
+        if rule['blocking']:
+            return rule['message']
+    return None
+
+# Show/hide all the input warnings in the browser as the user types, from INPUT_RULES
+app.clientside_callback(
+    """
+    function() {
+        var rules = %s, fields = %s, shown = %s, values = {};
+        for (var i = 0; i < fields.length; i++) {
+            var value = arguments[i];
+            values[fields[i]] = (value === null || value === undefined || value === '') ? NaN : Number(value);
+        }
+        var ops = {'<': function(a, b) { return a < b; }, '<=': function(a, b) { return a <= b; }};
+        return rules.map(function(rule) {
+            var left = values[rule.left], right = values[rule.right];
+            var broken = !isNaN(left) && !isNaN(right) && ops[rule.op](left, right);
+            return broken ? shown : {'display': 'none'};
+        });
+    }
+    """ % (json.dumps(INPUT_RULES), json.dumps(INPUT_RULE_FIELDS), json.dumps(WARNING_STYLE)),
+    [Output(rule['warning'], 'style') for rule in INPUT_RULES],
+    [Input(f'input-{field}', 'value') for field in INPUT_RULE_FIELDS]
 )
-def show_limit_excess_warning(limit, excess):
-    try:
-        if limit is not None and excess is not None and float(limit) < float(excess):
-            return {
-                'color': '#ffb347',
-                'fontSize': '0.95em',
-                'marginBottom': '10px',
-                'display': 'block'
-            }
-    except Exception:
-        pass
-    return {'display': 'none'}
+
+# Most points sent to the browser for the CDF trace
+CDF_MAX_POINTS = int(os.environ.get('REINSURANCE_CDF_POINTS', 2000))
+
+# Thin a sorted empirical CDF to at most max_points points. The budget is split
+# between ranks spaced evenly in probability, ranks at evenly spaced values and
+# log-spaced ranks from the top, so both axes and the tail out to the maximum keep
+# their shape. Each chosen point is moved to the end of its run of tied values,
+# which keeps atoms (like the jump at zero recoveries) exact.
+def downsample_cdf(cdf_x, cdf_y, max_points=CDF_MAX_POINTS):
+    n = len(cdf_x)
+    if n <= max_points:
+        return cdf_x, cdf_y
+    share = (max_points - 1) // 3
+    by_probability = np.linspace(0, n - 1, share).astype(np.int64)
+    by_value = np.searchsorted(cdf_x, np.linspace(cdf_x[0], cdf_x[-1], share), side='left')
+    by_tail = (n - np.geomspace(1, n, max_points - 1 - 2 * share)).astype(np.int64)
+    ranks = np.concatenate((by_probability, np.minimum(by_value, n - 1), by_tail))
+    ranks = np.searchsorted(cdf_x, cdf_x[ranks], side='right') - 1
+    ranks = np.unique(np.concatenate(([0], ranks)))
+    return cdf_x[ranks], cdf_y[ranks]
+
+# Smallest dtype that keeps a trace array exact enough to draw: float32 unless that
+# moves a value by more than a millionth of the array's range, and the narrowest
+# unsigned type for counts. Plotly ships NumPy arrays as base64 typed buffers, so
+# this sets the size of the figure data on the wire.
+def wire_array(values, rtol=1e-6):
+    values = np.asarray(values)
+    if values.dtype.kind in 'iu':
+        if values.size == 0 or values.min() >= 0:
+            for dtype in (np.uint8, np.uint16, np.uint32):
+                if values.size == 0 or values.max() <= np.iinfo(dtype).max:
+                    return values.astype(dtype)
+        return values
+    values = values.astype(np.float64)
+    single = values.astype(np.float32)
+    if values.size == 0:
+        return single
+    with np.errstate(over='ignore', invalid='ignore'):
+        error = np.max(np.abs(single.astype(np.float64) - values))
+    scale = np.ptp(values) or np.max(np.abs(values))
+    if np.isfinite(error) and error <= rtol * scale:
+        return single
+    return values
 
 # Main calculation and graph update callback
-@app.callback(
+UPDATE_OUTPUT_DEPENDENCIES = [
     Output('output-summary', 'children'),
     Output('recoveries-cdf', 'figure'),
     Output('recoveries-hist', 'figure'),
@@ -1413,24 +1624,73 @@ def show_limit_excess_warning(limit, excess):
     State('input-premium', 'value'),
     State('input-mean-frequency', 'value'),
     State('input-n-sims', 'value'),
+    State('input-gpd-shape', 'value'),
+    State('input-gpd-scale', 'value'),
+    State('input-gpd-loc', 'value'),
     State('theme-store', 'data'),
     State('show-raw-data', 'value'),
-    prevent_initial_call=True
-)
+    State('simulation-options', 'value'),
+    State('simulation-method', 'value'),
+    State('input-tolerance', 'value'),
+]
+
+# Analytic figures next to the simulated ones, when the cross-check option is on
+def analytic_cross_check(params, stats, simulation_options):
+    if 'cross-check' not in simulation_options:
+        return []
+    try:
+        preview = analytic_preview(params)
+    except ValueError as e:
+        return [html.P(f"Analytic cross-check unavailable: {e}")]
+    difference = f" (this run {(stats.mean - preview.mean) / preview.mean:+.2%})" if preview.mean else ""
+    return [
+        html.P(f"Analytic expected recoveries: {preview.mean:,.2f}{difference}"),
+        html.P(f"Analytic probability recoveries > 0: {preview.prob_gt_zero:.2%}"),
+        html.P(f"Analytic 99th percentile: {preview.percentile(99):,.2f}"),
+    ]
+
+# Simulations used by a run that stops on a tolerance, and whether it was reached
+def convergence_report(results):
+    if results.converged is None:
+        return []
+    if results.converged:
+        return [html.P(f"Simulations used: {results.stats.n:,} (tolerance reached)")]
+    return [html.P(
+        f"Simulations used: {results.stats.n:,} (tolerance not reached; increase the number of simulations)",
+        style=WARNING_STYLE
+    )]
+
+# A statistic with its standard error, when the run reports one
+def format_estimate(stats, key, value):
+    if stats.standard_errors is None:
+        return f"{value:,.2f}"
+    return f"{value:,.2f} ± {stats.standard_errors[key]:,.2f} (standard error)"
+
+# Outputs for a submit that stops before any graphs are drawn
+def message_output(message):
+    hide_style = {'display': 'none'}
+    return (
+        message,
+        go.Figure(), go.Figure(), go.Figure(), go.Figure(),
+        hide_style, hide_style, hide_style, hide_style,
+        None
+    )
+
 def update_output(
-    n_clicks, limit, aggregate_limit, policy_limit, excess, aggregate_deductible, premium, mean_frequency, n_sims, theme,
-    show_raw_data
+    set_progress, n_clicks, limit, aggregate_limit, policy_limit, excess, aggregate_deductible, premium, mean_frequency,
+    n_sims, gpd_shape, gpd_scale, gpd_loc, theme, show_raw_data, simulation_options, method, tolerance
 ):
+    def report_stage(stage):
+        set_progress((str(stage + 1), f"Step {stage + 1} of {len(SIMULATION_STAGES)}: {SIMULATION_STAGES[stage]}..."))
+
     # Validate user input
     if (
         limit is None or aggregate_limit is None or policy_limit is None or excess is None or
         aggregate_deductible is None or premium is None or mean_frequency is None or n_sims is None
     ):
-        return (
-            "Please enter limit, aggregate limit, policy limit, excess, aggregate deductible, premium, mean frequency, and number of simulations.",
-            go.Figure(), go.Figure(), go.Figure(),
-            {'display': 'none'}, {'display': 'none'}, {'display': 'none'}
-        )
+        return message_output("Please enter limit, aggregate limit, policy limit, excess, aggregate deductible, premium, mean frequency, and number of simulations.")
+    if gpd_shape is None or gpd_scale is None or gpd_loc is None:
+        return message_output("Please enter the GPD shape, scale and location.")
     try:
         limit = float(limit)
         aggregate_limit = float(aggregate_limit)
@@ -1440,298 +1700,133 @@ def update_output(
         premium = float(premium)
         mean_frequency = float(mean_frequency)
         n_sims = int(n_sims)
+        gpd_shape = float(gpd_shape)
+        gpd_scale = float(gpd_scale)
+        gpd_loc = float(gpd_loc)
     except Exception:
-        return (
-            "Inputs must be numbers.",
-            go.Figure(), go.Figure(), go.Figure(),
-            {'display': 'none'}, {'display': 'none'}, {'display': 'none'}
-        )
-    if aggregate_limit < limit:
-        return (
-            "Aggregate limit must be greater than or equal to limit.",
-            go.Figure(), go.Figure(), go.Figure(),
-            {'display': 'none'}, {'display': 'none'}, {'display': 'none'}
-        )
-    if aggregate_deductible <= excess:
-        return (
-            "Aggregate deductible must be greater than the excess as it is for a year rather than just one claim.",
-            go.Figure(), go.Figure(), go.Figure(),
-            {'display': 'none'}, {'display': 'none'}, {'display': 'none'}
-        )
-
-    config.n_sims = n_sims
-
-    sev_dist = distributions.GPD(shape=0.33, scale=100000, loc=1000000)
-    freq_dist = distributions.Poisson(mean=mean_frequency)
-    losses_pre_cap = FrequencySeverityModel(freq_dist, sev_dist).generate()
-    losses_post_cap = np.minimum(losses_pre_cap, policy_limit)
-    gross_losses = losses_post_cap
+        return message_output("Inputs must be numbers.")
+    if gpd_scale <= 0:
+        return message_output("GPD scale must be greater than 0.")
+    if 'parallel' in simulation_options and background_callback_manager is not None:
+        return message_output("Running on all CPU cores is not available when simulations run as background jobs.")
+    if 'adaptive' in simulation_options:
+        if tolerance is None or float(tolerance) <= 0:
+            return message_output("Please enter a tolerance greater than 0%.")
+        tolerance = float(tolerance) / 100
+    else:
+        tolerance = None
 
-    agg_limit = [aggregate_limit] if aggregate_limit else [None]
-    agg_deductible = [aggregate_deductible] if aggregate_deductible else [None]
-
-    prog = XoLTower(
-        limit=[limit],
-        excess=[excess],
-        aggregate_limit=agg_limit,
-        aggregate_deductible=agg_deductible,  
-        premium=[premium],
-        reinstatement_cost=[[1, 1, 1], [1, 1, 1], [1, 1, 1], [1, 1, 1], [1, 1, 1]],
-    )
-    prog_results = prog.apply(gross_losses)
-    recoveries_raw = prog_results.recoveries.aggregate()
-    recoveries = np.array(
-        [float(r.value) if hasattr(r, 'value') else float(r) for r in recoveries_raw],
-        dtype=float
-    ).flatten()
-    if recoveries.size == 0:
-        return (
-            "No recoveries generated.",
-            go.Figure(), go.Figure(), go.Figure(),
-            {'display': 'none'}, {'display': 'none'}, {'display': 'none'}
+    # Options the method cannot honour (streaming or all CPU cores outside Monte Carlo,
+    # or with a tolerance) are rejected here rather than silently ignored
+    try:
+        params = SimulationParams(
+            limit, aggregate_limit, policy_limit, excess, aggregate_deductible, premium, mean_frequency, n_sims,
+            gpd_shape=gpd_shape, gpd_scale=gpd_scale, gpd_loc=gpd_loc,
+            stream='stream' in simulation_options, parallel='parallel' in simulation_options, method=method,
+            tolerance=tolerance
         )
-    # Calculate statistics
-    expected_recoveries = float(np.mean(recoveries))
-    median_recoveries = float(np.median(recoveries))
-    counts, bin_edges = np.histogram(recoveries, bins=100)
-    mode_index = int(np.argmax(counts))
-    mode_recoveries = float((bin_edges[mode_index] + bin_edges[mode_index + 1]) / 2)
-    prob_gt_zero = float(np.mean(recoveries > 0))
+    except ValueError as e:
+        return message_output(str(e))
+    message = blocking_rule_message(params)
+    if message:
+        return message_output(message)
+    try:
+        results = run_simulation(params, report_stage)
+    except ValueError as e:
+        return message_output(str(e))
+    stats = results.stats
+    limits, excesses = results.effect_limits, results.effect_excesses
+    mean_rec_by_limit, mean_rec_by_excess = results.mean_rec_by_limit, results.mean_rec_by_excess
 
-    # Set outline color based on theme
-    graph_outline = "#23272E" if theme == "light" else "#FFFFFF"
+    report_stage(3)
+    template = FIGURE_TEMPLATES[theme]
 
     # CDF plot
-    sorted_rec = np.sort(recoveries)
-    cum_prob = np.arange(1, len(sorted_rec) + 1) / len(sorted_rec)
+    cdf_x, cdf_y = downsample_cdf(stats.cdf_x, stats.cdf_y)
     fig_cdf = go.Figure()
     fig_cdf.add_trace(go.Scatter(
-        x=sorted_rec,
-        y=cum_prob,
+        x=wire_array(cdf_x),
+        y=wire_array(cdf_y),
         name='Cumulative Probability',
         mode='lines',
         marker=dict(color='blue', size=4),
         line=dict(color='blue')
     ))
-    min_x = float(np.min(sorted_rec))
-    max_x = float(np.max(sorted_rec))
+    min_x = stats.min
+    max_x = float(stats.cdf_x[-1])
     x_margin = (max_x - min_x) * 0.05 if max_x > min_x else 1
     fig_cdf.update_layout(
         title='Recoveries',
         xaxis_title='value',
         yaxis_title='Cumulative Probability',
-        yaxis=dict(range=[0, 1], linecolor=graph_outline, gridcolor=graph_outline),
-        xaxis=dict(range=[min_x - x_margin, max_x + x_margin], linecolor=graph_outline, gridcolor=graph_outline),
-        plot_bgcolor='white' if theme == "light" else "#23272E",
-        paper_bgcolor='white' if theme == "light" else "#23272E",
-        font=dict(color=graph_outline),
-        margin=dict(l=40, r=40, t=40, b=40),
-        legend=dict(font=dict(color=graph_outline))
+        yaxis=dict(range=[0, 1]),
+        xaxis=dict(range=[min_x - x_margin, max_x + x_margin]),
+        template=template
     )
 
-    # Histogram plot
+    # Histogram plot: counts are binned on the server (the same bins used for the
+    # mode) and drawn as bars, so only the bins are sent to the browser
+    hist_title = 'Histogram of Recoveries'
+    hist_xaxis_type = 'linear'
+    hist_counts, hist_edges = stats.hist_counts, stats.hist_edges
+    if 'log-bins' in simulation_options and stats.prob_gt_zero > 0:
+        hist_counts, hist_edges = stats.log_histogram()
+        hist_title = f'Histogram of Recoveries (log bins, {round(stats.n * (1 - stats.prob_gt_zero)):,} zero recoveries not shown)'
+        hist_xaxis_type = 'log'
     fig_hist = go.Figure()
-    fig_hist.add_trace(go.Histogram(
-        x=recoveries,
-        nbinsx=50,
+    fig_hist.add_trace(go.Bar(
+        x=wire_array((hist_edges[:-1] + hist_edges[1:]) / 2),
+        y=wire_array(hist_counts),
+        width=wire_array(np.diff(hist_edges)),
         marker_color='orange',
         name='Recoveries Histogram',
         opacity=0.8
     ))
     fig_hist.update_layout(
-        title='Histogram of Recoveries',
+        title=hist_title,
         xaxis_title='Recoveries',
         yaxis_title='Count',
-        plot_bgcolor='white' if theme == "light" else "#23272E",
-        paper_bgcolor='white' if theme == "light" else "#23272E",
-        font=dict(color=graph_outline),
-        margin=dict(l=40, r=40, t=40, b=40),
-        legend=dict(font=dict(color=graph_outline)),
-        xaxis=dict(linecolor=graph_outline, gridcolor=graph_outline),
-        yaxis=dict(linecolor=graph_outline, gridcolor=graph_outline)
+        bargap=0,
+        xaxis=dict(type=hist_xaxis_type),
+        template=template
     )
 
-    # Pie chart calculation: bin recoveries into ranges
-    total = recoveries.size
-    count_zero = np.sum(recoveries == 0)
-    count_0_10k = np.sum((recoveries > 1000) & (recoveries <= 10000))
-    count_10k_50k = np.sum((recoveries > 10000) & (recoveries <= 50000))
-    count_50k_100k = np.sum((recoveries > 50000) & (recoveries <= 100000))
-    count_100k_1m = np.sum((recoveries > 100000) & (recoveries <= 1000000))
-    count_1m_10m = np.sum((recoveries > 1000000) & (recoveries <= 10000000))
-    count_10m_25m = np.sum((recoveries > 10_000_000) & (recoveries <= 25_000_000))
-    count_25m_50m = np.sum((recoveries > 25_000_000) & (recoveries <= 50_000_000))
-    count_50m_75m = np.sum((recoveries > 50_000_000) & (recoveries <= 75_000_000))
-    count_75m_100m = np.sum((recoveries > 75_000_000) & (recoveries <= 100_000_000))
-    count_100m_250m = np.sum((recoveries > 100_000_000) & (recoveries <= 250_000_000))
-    count_250m_500m = np.sum((recoveries > 250_000_000) & (recoveries <= 500_000_000))
-    count_500m_750m = np.sum((recoveries > 500_000_000) & (recoveries <= 750_000_000))
-    count_750m_1b = np.sum((recoveries > 750_000_000) & (recoveries <= 1_000_000_000))
-    count_1b_2_5b = np.sum((recoveries > 1_000_000_000) & (recoveries <= 2_500_000_000))
-    count_2b_5b = np.sum((recoveries > 2_000_000_000) & (recoveries <= 5_000_000_000))
-    count_5b_10b = np.sum((recoveries > 5_000_000_000) & (recoveries <= 10_000_000_000))
-    count_10b_25b = np.sum((recoveries > 10_000_000_000) & (recoveries <= 25_000_000_000))
-    count_25b_50b = np.sum((recoveries > 25_000_000_000) & (recoveries <= 50_000_000_000))
-    count_50b_75b = np.sum((recoveries > 50_000_000_000) & (recoveries <= 75_000_000_000))
-    count_75b_100b = np.sum((recoveries > 75_000_000_000) & (recoveries <= 100_000_000_000))
-    count_100b_250b = np.sum((recoveries > 100_000_000_000) & (recoveries <= 250_000_000_000))
-    count_250b_500b = np.sum((recoveries > 250_000_000_000) & (recoveries <= 500_000_000_000))
-    count_500b_750b = np.sum((recoveries > 500_000_000_000) & (recoveries <= 750_000_000_000))
-    count_750b_1t = np.sum((recoveries > 750_000_000_000) & (recoveries <= 1_000_000_000_000))
-    count_gt_1t = np.sum(recoveries > 1_000_000_000_000)
-
-    pie_labels = [
-        "Recoveries = 0",
-        "Recoveries = 0-10K",
-        "Recoveries = 10K-50K",
-        "Recoveries = 50K-100K",
-        "Recoveries = 100K-1M",
-        "Recoveries = 1M-10M"
-    ]
-    pie_values = [count_zero, count_0_10k, count_10k_50k, count_50k_100k, count_100k_1m, count_1m_10m]
-
-    # Add higher bins if needed
-    max_rec = recoveries.max()
-    if max_rec > 10_000_000:
-        pie_labels.append("Recoveries = 10M-25M")
-        pie_values.append(count_10m_25m)
-    if max_rec > 25_000_000:
-        pie_labels.append("Recoveries = 25M-50M")
-        pie_values.append(count_25m_50m)
-    if max_rec > 50_000_000:
-        pie_labels.append("Recoveries = 50M-75M")
-        pie_values.append(count_50m_75m)
-    if max_rec > 75_000_000:
-        pie_labels.append("Recoveries = 75M-100M")
-        pie_values.append(count_75m_100m)
-    if max_rec > 100_000_000:
-        pie_labels.append("Recoveries = 100M-250M")
-        pie_values.append(count_100m_250m)
-    if max_rec > 250_000_000:
-        pie_labels.append("Recoveries = 250M-500M")
-        pie_values.append(count_250m_500m)
-    if max_rec > 500_000_000:
-        pie_labels.append("Recoveries = 500M-750M")
-        pie_values.append(count_500m_750m)
-    if max_rec > 750_000_000:
-        pie_labels.append("Recoveries = 750M-1B")
-    if max_rec > 1_000_000_000:
-        pie_labels.append("Recoveries = 1B-2.5B")
-        pie_values.append(count_1b_2_5b)
-    if max_rec > 2_000_000_000:
-        pie_labels.append("Recoveries = 2.5B-5B")
-        pie_values.append(count_2b_5b)
-    if max_rec > 5_000_000_000:
-        pie_labels.append("Recoveries = 5B-10B")
-        pie_values.append(count_5b_10b)
-    if max_rec > 10_000_000_000:
-        pie_labels.append("Recoveries = 10B-25B")
-        pie_values.append(count_10b_25b)
-    if max_rec > 25_000_000_000:
-        pie_labels.append("Recoveries = 25B-50B")
-        pie_values.append(count_25b_50b)
-    if max_rec > 50_000_000_000:
-        pie_labels.append("Recoveries = 50B-75B")
-        pie_values.append(count_50b_75b)
-    if max_rec > 75_000_000_000:
-        pie_labels.append("Recoveries = 75B-100B")
-        pie_values.append(count_75b_100b)
-    if max_rec > 100_000_000_000:
-        pie_labels.append("Recoveries = 100B-250B")
-        pie_values.append(count_100b_250b)
-    if max_rec > 250_000_000_000:
-        pie_labels.append("Recoveries = 250B-500B")
-        pie_values.append(count_250b_500b)
-    if max_rec > 500_000_000_000:
-        pie_labels.append("Recoveries = 500B-750B")
-        pie_values.append(count_500b_750b)
-    if max_rec > 750_000_000_000:
-        pie_labels.append("Recoveries = 750B-1T")
-        pie_values.append(count_750b_1t)
-    if max_rec > 1_000_000_000_000:
-        pie_labels.append("Recoveries > 1T")
-        pie_values.append(count_gt_1t)
-
-    # Only show bins with values
+    # Pie chart: only show the ranges that contain recoveries
     filtered_labels = []
     filtered_values = []
-    for label, value in zip(pie_labels, pie_values):
+    for label, value in zip(PIE_BUCKET_LABELS, stats.pie_counts):
         if value > 0:
             filtered_labels.append(label)
-            filtered_values.append(value)
+            filtered_values.append(round(float(value), 2))
 
     fig_pie = go.Figure(
         data=[go.Pie(labels=filtered_labels, values=filtered_values, hole=0.3)]
     )
     fig_pie.update_layout(
         title="Recovery Distribution",
-        plot_bgcolor='white' if theme == "light" else "#23272E",
-        paper_bgcolor='white' if theme == "light" else "#23272E",
-        font=dict(color=graph_outline),
         legend=dict(
             orientation="v",
             y=-0.8,
             x=0.5,
-            xanchor="center",
-            font=dict(color=graph_outline)
+            xanchor="center"
         ),
-        margin=dict(l=40, r=40, t=40, b=40)
+        template=template
     )
 
     # Effects line graph: show how mean recoveries change with limit/excess
-    limits = np.linspace(0, 10_000_000, 11)
-    excesses = np.linspace(0, max(limit-1, 10_000_000), 11)
-    mean_rec_by_limit = []
-    mean_rec_by_excess = []
-
-    for l in limits:
-        prog = XoLTower(
-            limit=[l],
-            excess=[excess],
-            aggregate_limit=[None],
-            premium=[premium],
-            reinstatement_cost=[[1, 1, 1], [1, 1, 1], [1, 1, 1], [1, 1, 1], [1, 1, 1]],
-        )
-        prog_results = prog.apply(gross_losses)
-        recs = np.array(
-            [float(r.value) if hasattr(r, 'value') else float(r) for r in prog_results.recoveries.aggregate()],
-            dtype=float
-        ).flatten()
-        mean_rec_by_limit.append(np.mean(recs))
-
-    for e in excesses:
-        prog = XoLTower(
-            limit=[limit],
-            excess=[e],
-            aggregate_limit=[None],
-            premium=[premium],
-            reinstatement_cost=[[1, 1, 1], [1, 1, 1], [1, 1, 1], [1, 1, 1], [1, 1, 1]],
-        )
-        prog_results = prog.apply(gross_losses)
-        recs = np.array(
-            [float(r.value) if hasattr(r, 'value') else float(r) for r in prog_results.recoveries.aggregate()],
-            dtype=float
-        ).flatten()
-        mean_rec_by_excess.append(np.mean(recs))
-
     fig_effects = go.Figure()
     fig_effects.add_trace(go.Scatter(
-        x=limits, y=mean_rec_by_limit, mode='lines+markers', name='Varying Limit'
+        x=wire_array(limits), y=wire_array(mean_rec_by_limit), mode='lines+markers', name='Varying Limit'
     ))
     fig_effects.add_trace(go.Scatter(
-        x=excesses, y=mean_rec_by_excess, mode='lines+markers', name='Varying Excess'
+        x=wire_array(excesses), y=wire_array(mean_rec_by_excess), mode='lines+markers', name='Varying Excess'
     ))
     fig_effects.update_layout(
         title="Effect of Limit and excess on Expected Recoveries",
         xaxis_title="Parameter Value",
         yaxis_title="Expected Recoveries",
-        legend=dict(orientation="h", y=-0.2, font=dict(color=graph_outline)),
-        plot_bgcolor='white' if theme == "light" else "#23272E",
-        paper_bgcolor='white' if theme == "light" else "#23272E",
-        font=dict(color=graph_outline),
-        xaxis=dict(linecolor=graph_outline, gridcolor=graph_outline),
-        yaxis=dict(linecolor=graph_outline, gridcolor=graph_outline),
-        margin=dict(l=40, r=40, t=40, b=40)
+        legend=dict(orientation="h", y=-0.2),
+        template=template
     )
 
     # Statistics summary for display
@@ -1745,15 +1840,20 @@ def update_output(
                 'fontWeight': 'bold'
             }
         ),
-        html.P(f"Expected recoveries (mean): {expected_recoveries:,.2f}"),
-        html.P(f"Mode of recoveries: {mode_recoveries:,.2f}"),
-        html.P(f"Probability recoveries > 0: {prob_gt_zero:.2%}"),
-        html.P(f"1st percentile: {np.percentile(recoveries, 1):,.2f}"),
-        html.P(f"25th percentile: {np.percentile(recoveries, 25):,.2f}"),
-        html.P(f"Median recoveries: {median_recoveries:,.2f}"),
-        html.P(f"75th percentile: {np.percentile(recoveries, 75):,.2f}"),
-        html.P(f"99th percentile: {np.percentile(recoveries, 99):,.2f}"),
-        html.P(f"Worst case scenario (max): {np.max(recoveries):,.2f}") 
+        html.P(f"Expected recoveries (mean): {format_estimate(stats, 'mean', stats.mean)}"),
+        html.P(f"Mode of recoveries: {stats.mode:,.2f}"),
+        html.P(f"Probability recoveries > 0: {stats.prob_gt_zero:.2%}"),
+        html.P(f"1st percentile: {format_estimate(stats, 1, stats.percentiles[1])}"),
+        html.P(f"25th percentile: {format_estimate(stats, 25, stats.percentiles[25])}"),
+        html.P(f"Median recoveries: {format_estimate(stats, 50, stats.median)}"),
+        html.P(f"75th percentile: {format_estimate(stats, 75, stats.percentiles[75])}"),
+        html.P(f"99th percentile: {format_estimate(stats, 99, stats.percentiles[99])}"),
+        html.P(
+            f"Worst case scenario (max): {stats.max:,.2f}" if np.isfinite(stats.max)
+            else "Worst case scenario (max): unbounded (no aggregate limit)"
+        ),
+        *convergence_report(results),
+        *analytic_cross_check(params, stats, simulation_options)
     ])
 
     show_style = {'display': 'block'}
@@ -1761,16 +1861,23 @@ def update_output(
 
     # Raw data table (show only if requested)
     raw_data_table = None
-    if 'show' in show_raw_data:
+    if 'show' in show_raw_data and len(stats.sample):
         # Show first 100 recoveries for performance
         raw_data_table = dash_table.DataTable(
             columns=[{"name": "Recovery", "id": "Recovery"}],
-            data=[{"Recovery": f"{v:,.2f}"} for v in recoveries[:100]],
-            style_table={'height': '300px', 'overflowY': 'auto', 'backgroundColor': 'white' if theme == "light" else "#23272E"},
-            style_cell={'color': '#23272E' if theme == "light" else "#F5F6FA", 'backgroundColor': 'white' if theme == "light" else "#23272E"},
-            style_header={'backgroundColor': '#859EFF', 'color': '#23272E' if theme == "light" else "#F5F6FA"},
+            data=[{"Recovery": f"{v:,.2f}"} for v in stats.sample],
+            style_table={'height': '300px', 'overflowY': 'auto', 'backgroundColor': THEME_COLORS["card"]},
+            style_cell={'color': THEME_COLORS["text"], 'backgroundColor': THEME_COLORS["card"]},
+            style_header={'backgroundColor': '#859EFF', 'color': THEME_COLORS["text"]},
             page_size=100
         )
+    elif 'show' in show_raw_data:
+        # FFT and importance sampling give a distribution or weighted sample, not raw years
+        raw_data_table = html.P(
+            "Raw simulated recoveries are not available with this method; "
+            "choose Monte Carlo or quasi-Monte Carlo simulation to see them.",
+            style=WARNING_STYLE
+        )
 
     return (
         stats_html, fig_cdf, fig_hist, fig_effects, fig_pie,
@@ -1778,27 +1885,91 @@ def update_output(
         raw_data_table
     )
 
-# Hide simulation recommendation after submit
+if background_callback_manager is not None:
+    app.callback(
+        *UPDATE_OUTPUT_DEPENDENCIES,
+        background=True,
+        manager=background_callback_manager,
+        progress=[Output('simulation-progress', 'value'), Output('simulation-progress-label', 'children')],
+        running=[(Output('simulation-progress-container', 'style'), {'marginTop': '12px', 'display': 'block'}, {'display': 'none'})],
+        cancel=[Input('cancel-val', 'n_clicks')],
+        prevent_initial_call=True
+    )(update_output)
+else:
+    @app.callback(*UPDATE_OUTPUT_DEPENDENCIES, prevent_initial_call=True)
+    def update_output_in_request(*args):
+        return update_output(lambda progress: None, *args)
+
+# Instant analytic preview of the recoveries on submit, shown while the simulation runs
 @app.callback(
-    Output('sim-recommend-msg', 'style'),
+    Output('analytic-preview', 'children'),
     Input('submit-val', 'n_clicks'),
+    State('input-limit', 'value'),
+    State('input-aggregate-limit', 'value'),
+    State('input-policy-limit', 'value'),
+    State('input-excess', 'value'),
+    State('input-aggregate-deductible', 'value'),
+    State('input-mean-frequency', 'value'),
+    State('input-gpd-shape', 'value'),
+    State('input-gpd-scale', 'value'),
+    State('input-gpd-loc', 'value'),
+    prevent_initial_call=True
+)
+def update_analytic_preview(
+    n_clicks, limit, aggregate_limit, policy_limit, excess, aggregate_deductible, mean_frequency,
+    gpd_shape, gpd_scale, gpd_loc
+):
+    try:
+        params = SimulationParams(
+            limit, aggregate_limit, policy_limit, excess, aggregate_deductible, 0, mean_frequency, 1,
+            gpd_shape=gpd_shape, gpd_scale=gpd_scale, gpd_loc=gpd_loc
+        )
+        if params.gpd_scale <= 0 or blocking_rule_message(params):
+            return None
+        preview = analytic_preview(params)
+    except (TypeError, ValueError):
+        return None
+    return html.Div([
+        html.B("Analytic preview: "),
+        f"expected recoveries {preview.mean:,.2f}, probability recoveries > 0 {preview.prob_gt_zero:.2%}, "
+        f"99th percentile {preview.percentile(99):,.2f}"
+    ])
+
+# Restyle the result figures in the browser when the theme changes, by swapping in
+# the other template, so the simulation callback does not run again
+app.clientside_callback(
+    """
+    function(theme, templates, cdf, hist, effects, pie) {
+        return [cdf, hist, effects, pie].map(function(figure) {
+            if (!figure || !figure.data || !figure.data.length) {
+                return window.dash_clientside.no_update;
+            }
+            return Object.assign({}, figure, {
+                layout: Object.assign({}, figure.layout, {template: templates[theme]})
+            });
+        });
+    }
+    """,
+    Output('recoveries-cdf', 'figure', allow_duplicate=True),
+    Output('recoveries-hist', 'figure', allow_duplicate=True),
+    Output('effects-line', 'figure', allow_duplicate=True),
+    Output('recoveries-pie', 'figure', allow_duplicate=True),
+    Input('theme-store', 'data'),
+    State('figure-templates', 'data'),
+    State('recoveries-cdf', 'figure'),
+    State('recoveries-hist', 'figure'),
+    State('effects-line', 'figure'),
+    State('recoveries-pie', 'figure'),
     prevent_initial_call=True
 )
-def hide_sim_recommend_msg(n_clicks):
-    return {'display': 'none'}
 
-# show/hide aggregate limit warning based on input changes
+# Hide simulation recommendation after submit
 @app.callback(
-    Output('aggregate-limit-warning', 'style'),
-    Input('input-limit', 'value'),
-    Input('input-aggregate-limit', 'value'),
+    Output('sim-recommend-msg', 'style'),
+    Input('submit-val', 'n_clicks'),
+    prevent_initial_call=True
 )
-def show_aggregate_limit_warning(limit, aggregate_limit):
-    try:
-        if aggregate_limit is not None and limit is not None and float(aggregate_limit) < float(limit):
-            return {'color': '#ffb347', 'fontSize': '0.95em', 'marginBottom': '10px', 'display': 'block'}
-    except Exception:
-        pass
+def hide_sim_recommend_msg(n_clicks):
     return {'display': 'none'}
 
 # Fullscreen functionality for home cards
@@ -1815,16 +1986,15 @@ def show_aggregate_limit_warning(limit, aggregate_limit):
         Input("language-fullscreen-btn", "n_clicks"),
         Input("source-fullscreen-btn", "n_clicks"),
         Input("faq-fullscreen-btn", "n_clicks"),
-        Input("theme-store", "data"),
     ],
     State("home-fullscreen-card", "data"),
 )
 def fullscreen_home_card(
-    purpose_click, language_click, source_click, faq_click, theme, fullscreen_card
+    purpose_click, language_click, source_click, faq_click, fullscreen_card
 ):
     ctx_triggered = ctx.triggered_id
     card_ids = ["purpose", "language", "source", "faq"]
-    card_bg = THEMES[theme]["card"]
+    card_bg = THEME_COLORS["card"]
     # Default card font size
     base_font_size = '1em'
     fullscreen_font_size = '2em'
@@ -1884,4 +2054,4 @@ def fullscreen_home_card(
     return [card_styles[0], card_styles[1], card_styles[2], card_styles[3], None]
 
 if __name__ == '__main__':
-    app.run(debug=False,host="0.0.0.0")
\ No newline at end of file
+    app.run(debug=False,host="0.0.0.0",threaded=True)
\ No newline at end of file
@@ -0,0 +1,215 @@
+# Batch pricing of many layer structures from a CSV or Parquet file, one scenario
+# per row, using the headless engine across a process pool. Scenarios that share a
+# loss model (frequency, GPD parameters, n_sims and seed) run in the same worker,
+# so their losses are simulated once and reused from the engine's cache. With
+# --stream no losses are kept, so each scenario simulates its own (same-seed) chunks.
+# Blank aggregate_limit or aggregate_deductible cells mean none; a blank in any other
+# required column marks the row invalid.
+#
+# With --compare, the layers in each group are priced on exactly the same losses and
+# each row also reports its difference from the first row of its group. With
+# --method fft, each layer's recovery distribution is computed exactly on a grid
+# instead of simulated, and --method importance spends every simulation on years
+# that reach the layer. --method sobol uses scrambled Sobol points and adds standard
+# error columns. --tolerance stops each simulation once its estimates are precise
+# enough, treating n_sims as the maximum.
+#
+#   python reinsurance_batch.py scenarios.csv results.parquet --workers 8
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import multiprocessing
+import sys
+import time
+
+import pandas as pd
+
+from reinsurance_engine import (
+    DEFAULT_GPD_LOC, DEFAULT_GPD_SCALE, DEFAULT_GPD_SHAPE, SIMULATION_METHODS, SIMULATION_WORKERS,
+    SUMMARY_PERCENTILES, SimulationParams, run_comparison, run_simulation
+)
+
+REQUIRED_COLUMNS = [
+    'limit', 'excess', 'aggregate_limit', 'aggregate_deductible', 'premium', 'policy_limit', 'mean_frequency', 'n_sims'
+]
+# Required columns whose blank cells mean none, as 0 does on the page; blanks in the
+# other required columns make the scenario invalid
+AGGREGATE_COLUMNS = ('aggregate_limit', 'aggregate_deductible')
+OPTIONAL_COLUMNS = {
+    'gpd_shape': DEFAULT_GPD_SHAPE,
+    'gpd_scale': DEFAULT_GPD_SCALE,
+    'gpd_loc': DEFAULT_GPD_LOC,
+    'seed': None,
+}
+
+# Tables are read and written as CSV or Parquet depending on the file extension
+# (Parquet needs pyarrow or fastparquet installed)
+def read_table(path):
+    if path.lower().endswith('.parquet'):
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
+
+def write_table(table, path):
+    if path.lower().endswith('.parquet'):
+        table.to_parquet(path, index=False)
+    else:
+        table.to_csv(path, index=False)
+
+def scenario_params(row, stream=False, method='simulation', tolerance=None):
+    values = {}
+    for name in REQUIRED_COLUMNS:
+        value = row[name]
+        if value is None or pd.isna(value):
+            if name not in AGGREGATE_COLUMNS:
+                raise ValueError(f"missing {name}")
+            value = 0
+        values[name] = value
+    for name, default in OPTIONAL_COLUMNS.items():
+        value = row.get(name)
+        values[name] = default if value is None or pd.isna(value) else value
+    if values['seed'] is not None:
+        values['seed'] = int(values['seed'])
+    return SimulationParams(**values, stream=stream, method=method, tolerance=tolerance)
+
+def scenario_summary(stats, premium, converged=None):
+    summary = {
+        'mean': stats.mean,
+        'mode': stats.mode,
+        'prob_gt_zero': stats.prob_gt_zero,
+        'min': stats.min,
+        'max': stats.max,
+    }
+    for q in SUMMARY_PERCENTILES:
+        summary[f'p{q}'] = stats.percentiles[q]
+    summary['loss_ratio'] = stats.mean / premium if premium else float('nan')
+    if stats.standard_errors is not None:
+        summary['se_mean'] = stats.standard_errors['mean']
+        for q in SUMMARY_PERCENTILES:
+            summary[f'se_p{q}'] = stats.standard_errors[q]
+    if converged is not None:
+        summary['n_sims_used'] = stats.n
+        summary['converged'] = converged
+    summary['error'] = None
+    return summary
+
+# Each row's recoveries minus those of the first row in its group, per simulation
+def difference_summary(baseline_row, stats, se):
+    summary = {
+        'baseline_row': baseline_row,
+        'diff_mean': stats.mean,
+        'diff_se': se,
+        'diff_prob_gt_zero': stats.prob_gt_zero,
+    }
+    for q in SUMMARY_PERCENTILES:
+        summary[f'diff_p{q}'] = stats.percentiles[q]
+    return summary
+
+# Text for a row's error column; anything other than the engine's ValueErrors is
+# unexpected, so its type is kept
+def error_message(error):
+    if isinstance(error, ValueError):
+        return str(error)
+    return f"{type(error).__name__}: {error}"
+
+# Price a group of scenarios that share a loss model on the same losses in one pass
+def compare_group(group):
+    indexes = [index for index, _ in group]
+    try:
+        results = run_comparison([params for _, params in group])
+    except Exception as e:
+        return [(index, {'error': error_message(e)}) for index in indexes]
+    rows = [(indexes[0], {**scenario_summary(results.stats[0], group[0][1].premium), 'baseline_row': indexes[0]})]
+    for (index, params), stats, difference_stats, se in zip(
+        group[1:], results.stats[1:], results.difference_stats, results.difference_se
+    ):
+        rows.append((index, {**scenario_summary(stats, params.premium), **difference_summary(indexes[0], difference_stats, se)}))
+    return rows
+
+# Run one group of scenarios that share a loss model, returning (row, summary) pairs
+def run_group(group, compare=False):
+    if compare:
+        return compare_group(group)
+    rows = []
+    for index, params in group:
+        try:
+            results = run_simulation(params)
+            rows.append((index, scenario_summary(results.stats, params.premium, results.converged)))
+        except Exception as e:
+            rows.append((index, {'error': error_message(e)}))
+    return rows
+
+def run_batch(scenarios, n_workers=SIMULATION_WORKERS, stream=False, compare=False, method='simulation',
+              tolerance=None):
+    groups = {}
+    summaries = {}
+    for index, row in enumerate(scenarios.to_dict('records')):
+        try:
+            params = scenario_params(row, stream, method, tolerance)
+        except (KeyError, TypeError, ValueError) as e:
+            summaries[index] = {'error': f"Invalid scenario: {e}"}
+            continue
+        groups.setdefault(params.loss_key, []).append((index, params))
+
+    n_workers = max(1, min(n_workers, len(groups)))
+    if n_workers == 1:
+        for rows in map(run_group, groups.values(), repeat(compare)):
+            summaries.update(rows)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            for rows in pool.map(run_group, groups.values(), repeat(compare)):
+                summaries.update(rows)
+
+    summary_table = pd.DataFrame([summaries[i] for i in range(len(scenarios))])
+    return pd.concat([scenarios.reset_index(drop=True), summary_table], axis=1), len(groups)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run reinsurance layer scenarios from a CSV or Parquet file.")
+    parser.add_argument('scenarios', help="input .csv or .parquet, one scenario per row with columns "
+                        + ", ".join(REQUIRED_COLUMNS) + " and optionally " + ", ".join(OPTIONAL_COLUMNS))
+    parser.add_argument('output', help="output .csv or .parquet with the inputs and summary statistics")
+    parser.add_argument('--workers', type=int, default=SIMULATION_WORKERS, help="worker processes (default: all cores)")
+    parser.add_argument('--stream', action='store_true', help="simulate in chunks to keep memory flat for very large n_sims "
+                             "(losses are then not shared between scenarios; --method simulation only)")
+    parser.add_argument('--compare', action='store_true',
+                        help="price scenarios sharing a loss model on the same losses and report differences from "
+                             "the first scenario of each group")
+    parser.add_argument('--method', choices=SIMULATION_METHODS, default='simulation',
+                        help="simulate recoveries, compute their distribution exactly by FFT, simulate only the years "
+                             "that reach the layer, or simulate with scrambled Sobol points (default: simulation)")
+    parser.add_argument('--tolerance', type=float,
+                        help="stop simulating once the standard errors of the mean and 99th percentile are within "
+                             "this fraction of their values (e.g. 0.01), running at most n_sims")
+    args = parser.parse_args(argv)
+
+    scenarios = read_table(args.scenarios)
+    missing = [name for name in REQUIRED_COLUMNS if name not in scenarios.columns]
+    if missing:
+        parser.error("missing columns: " + ", ".join(missing))
+    if scenarios.empty:
+        parser.error("no scenarios in " + args.scenarios)
+    if args.compare and args.method != 'simulation':
+        parser.error("--compare needs simulated losses (--method simulation)")
+    if args.stream and (args.compare or args.method != 'simulation'):
+        parser.error("--stream needs --method simulation without --compare")
+    if args.tolerance is not None and (
+        args.tolerance <= 0 or args.compare or args.stream or args.method != 'simulation'
+    ):
+        parser.error("--tolerance must be positive and needs --method simulation without --compare or --stream")
+
+    start = time.perf_counter()
+    table, n_loss_models = run_batch(scenarios, args.workers, args.stream, args.compare, args.method, args.tolerance)
+    elapsed = time.perf_counter() - start
+    write_table(table, args.output)
+
+    n_done = int(table['error'].isna().sum())
+    n_sims_column = 'n_sims_used' if 'n_sims_used' in table.columns else 'n_sims'
+    n_sims = int(table.loc[table['error'].isna(), n_sims_column].sum())
+    print(
+        f"{n_done} of {len(table)} scenarios ({n_loss_models} loss models, {n_sims:,} simulations) "
+        f"in {elapsed:.2f}s: {n_done / elapsed:.2f} scenarios/s, {n_sims / elapsed:,.0f} simulations/s",
+        file=sys.stderr
+    )
+    return 0 if n_done == len(table) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
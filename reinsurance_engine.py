@@ -0,0 +1,1262 @@
+# Headless reinsurance simulation engine: loss simulation, the XoL tower, summary
+# statistics and the limit/excess sweep, returning NumPy arrays. It has no Dash or
+# Plotly imports, so batch jobs and benchmarks can use it without the web app, and
+# the parallel worker processes only need to import this module.
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import multiprocessing
+import os
+import threading
+import warnings
+
+from pal import config, XoLTower, distributions
+from pal.frequency_severity import FreqSevSims
+import numpy as np
+from scipy.stats import poisson, qmc
+
+# Ways to compute the recovery distribution: Monte Carlo simulation, the exact
+# compound distribution on a grid via FFT, simulation of only the years that reach
+# the layer (importance sampling), or quasi-Monte Carlo with scrambled Sobol points
+SIMULATION_METHODS = ('simulation', 'fft', 'importance', 'sobol')
+
+# Grid points for the FFT aggregate distribution: at least FFT_POINTS, and enough for
+# FFT_MIN_CLAIM_STEPS steps per claim, up to FFT_MAX_POINTS (powers of two keep the
+# FFT fast)
+FFT_POINTS = int(os.environ.get('REINSURANCE_FFT_POINTS', 2 ** 16))
+FFT_MIN_CLAIM_STEPS = 1024
+FFT_MAX_POINTS = int(os.environ.get('REINSURANCE_FFT_MAX_POINTS', 2 ** 22))
+
+# Probabilities below this are FFT round-off and are dropped, and totals further out
+# in the tail than this are merged into the largest total kept
+FFT_PROBABILITY_FLOOR = 1e-15
+FFT_TAIL = 1e-10
+
+# Independently scrambled Sobol blocks per quasi-Monte Carlo run; the spread of the
+# estimates across blocks gives their standard errors
+QMC_REPLICATES = int(os.environ.get('REINSURANCE_QMC_REPLICATES', 8))
+
+# Most Sobol coordinates per simulated year (one for the claim count, one per claim)
+QMC_MAX_DIMENSIONS = 256
+
+# Adaptive runs: the fewest years per batch, the most convergence checks per run, the
+# fewest years before the first check, and the percentiles that must converge along
+# with the mean
+ADAPTIVE_BATCH_SIMS = int(os.environ.get('REINSURANCE_ADAPTIVE_BATCH_SIMS', 5_000))
+ADAPTIVE_MAX_BATCHES = 50
+ADAPTIVE_MIN_SIMS = 20_000
+ADAPTIVE_PERCENTILES = (99,)
+
+# Settings for a single simulation run. The sim count and random generator are
+# handed to PAL explicitly instead of being set on the shared pal.config, so
+# concurrent requests with different settings cannot corrupt each other's runs.
+class SimulationContext:
+    def __init__(self, n_sims, seed=None):
+        self.n_sims = int(n_sims)
+        self.seed = config.seed if seed is None else seed
+        self.rng = np.random.default_rng(self.seed)
+
+    # Poisson claim counts and one uniform per claim, drawn from the generator in the
+    # same order as FrequencySeverityModel.generate, so GPD losses built from them
+    # are identical to PAL's. Chunks of a larger run pass n_sims and may have no claims.
+    def draw_claims(self, mean_frequency, n_sims=None, require_claims=True):
+        n_sims = self.n_sims if n_sims is None else n_sims
+        n_events = self.rng.poisson(mean_frequency, n_sims)
+        if require_claims and n_events.sum() < 1:
+            raise ValueError("No claims were simulated; increase the mean frequency or number of simulations.")
+        uniforms = self.rng.uniform(size=int(n_events.sum()))
+        return ClaimDraws(np.repeat(np.arange(n_sims), n_events), uniforms, n_sims)
+
+    # Claim draws driven by scrambled Sobol points instead of pseudo-random ones, in
+    # n_replicates independently scrambled blocks of consecutive simulations. Year i of
+    # a block takes Sobol point i: coordinate 0 gives its claim count through the
+    # Poisson inverse CDF and coordinate j its j-th claim's uniform. Claims beyond the
+    # last coordinate (rare once the dimension covers the likely claim counts) fall
+    # back to pseudo-random uniforms.
+    def draw_sobol_claims(self, mean_frequency, n_replicates):
+        dimension = 1 + int(min(max(poisson.ppf(1 - 1e-6, mean_frequency), 1), QMC_MAX_DIMENSIONS))
+        n_events, uniforms = [], []
+        for size in replicate_sizes(self.n_sims, n_replicates):
+            with warnings.catch_warnings():
+                # Sizes that are not powers of two lose some balance, but stay unbiased
+                warnings.simplefilter('ignore', UserWarning)
+                points = qmc.Sobol(dimension, scramble=True, seed=self.rng).random(size)
+            counts = poisson_invcdf(points[:, 0], mean_frequency)
+            sim_index = np.repeat(np.arange(size), counts)
+            claim_number = np.arange(sim_index.size) - np.repeat(np.cumsum(counts) - counts, counts)
+            block_uniforms = points[sim_index, 1 + np.minimum(claim_number, dimension - 2)]
+            beyond = claim_number >= dimension - 1
+            block_uniforms[beyond] = self.rng.uniform(size=int(beyond.sum()))
+            n_events.append(counts)
+            uniforms.append(block_uniforms)
+        n_events = np.concatenate(n_events)
+        if n_events.sum() < 1:
+            raise ValueError("No claims were simulated; increase the mean frequency or number of simulations.")
+        return ClaimDraws(np.repeat(np.arange(self.n_sims), n_events), np.concatenate(uniforms), self.n_sims)
+
+    # Claims above a severity threshold, in years conditioned on having at least one.
+    # Such claims arrive as a Poisson process with the given rate over the year; given
+    # one arrival, the first arrival time is a truncated exponential and the rest are
+    # Poisson over what is left of the year. Each claim's uniform is drawn on
+    # (threshold_cdf, 1), so its severity is conditioned on exceeding the threshold.
+    def draw_tail_claims(self, rate, threshold_cdf):
+        first = -np.log1p(self.rng.uniform(size=self.n_sims) * np.expm1(-rate)) / rate
+        n_events = 1 + self.rng.poisson(rate * (1 - first))
+        uniforms = threshold_cdf + (1 - threshold_cdf) * self.rng.uniform(size=int(n_events.sum()))
+        return ClaimDraws(np.repeat(np.arange(self.n_sims), n_events), uniforms, self.n_sims)
+
+# GPD inverse CDF, written as pal.distributions.GPD.invcdf so results match PAL bit
+# for bit, with the exponential limit when the shape is zero
+def gpd_invcdf(u, shape, scale, loc):
+    if abs(shape) <= 1e-10:
+        return -np.log(1 - u) * scale + loc
+    return (np.exp(np.log(1 - u) * (-shape)) - 1) * (scale / shape) + loc
+
+# The random part of a frequency-severity simulation: which simulation each claim
+# belongs to and the uniform behind its severity. Losses for any GPD parameters are
+# then just the inverse CDF of the uniforms, with no new random draws.
+class ClaimDraws:
+    def __init__(self, sim_index, uniforms, n_sims):
+        self.sim_index = sim_index
+        self.uniforms = uniforms
+        self.n_sims = n_sims
+        # Shared between requests through the cache, so frozen
+        self.sim_index.flags.writeable = False
+        self.uniforms.flags.writeable = False
+
+    @property
+    def nbytes(self):
+        return self.sim_index.nbytes + self.uniforms.nbytes
+
+    def losses(self, gpd_shape, gpd_scale, gpd_loc):
+        return FreqSevSims(self.sim_index, gpd_invcdf(self.uniforms, gpd_shape, gpd_scale, gpd_loc), self.n_sims)
+
+# Simulated losses for one set of model parameters, plus the recoveries already
+# derived from them for each tower that has been applied
+class SimulationEntry:
+    def __init__(self, losses):
+        self.losses = losses
+        self.recoveries = {}
+
+    # PAL variables hold weak references, which cannot be pickled, so an entry written
+    # to a shared cache keeps its losses as plain arrays
+    def __getstate__(self):
+        return (self.losses.sim_index, self.losses.values, self.losses.n_sims), self.recoveries
+
+    def __setstate__(self, state):
+        (sim_index, values, n_sims), self.recoveries = state
+        self.losses = FreqSevSims(sim_index, values, n_sims)
+
+    @property
+    def nbytes(self):
+        return (
+            self.losses.sim_index.nbytes + self.losses.values.nbytes +
+            sum(r.nbytes for r in self.recoveries.values())
+        )
+
+# Bounded LRU cache of simulations keyed on (frequency mean, GPD parameters, n_sims,
+# seed). Resubmitting the same portfolio, or only changing the theme, premium or a
+# display option, reuses the stored losses and recoveries instead of simulating again.
+class SimulationCache:
+    def __init__(self, max_bytes=512 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._nbytes -= old.nbytes
+            self._entries[key] = entry
+            self._nbytes += entry.nbytes
+            self._evict()
+        return entry
+
+    def add_recoveries(self, key, tower_key, recoveries):
+        # Cached arrays are shared between requests, so they are frozen
+        recoveries.flags.writeable = False
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or tower_key in entry.recoveries:
+                return
+            entry.recoveries[tower_key] = recoveries
+            self._nbytes += recoveries.nbytes
+            self._evict()
+
+    def _evict(self):
+        while self._entries and self._nbytes > self.max_bytes:
+            _, entry = self._entries.popitem(last=False)
+            self._nbytes -= entry.nbytes
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+                'bytes': self._nbytes,
+                'max_bytes': self.max_bytes,
+            }
+
+simulation_cache = SimulationCache()
+
+# Claim draws keyed on (frequency mean, n_sims, seed), so changing only the severity
+# parameters recomputes the inverse CDF instead of simulating again
+claim_draw_cache = SimulationCache(max_bytes=256 * 1024 ** 2)
+
+# The same interface as SimulationCache over a diskcache.Cache that several processes
+# open, for when each run is its own short-lived process and an in-memory cache would
+# be lost with it. Entries are pickled, so every get returns a private copy; the
+# diskcache size limit and LRU eviction take the place of max_bytes.
+class SharedSimulationCache:
+    def __init__(self, cache, name):
+        self.cache = cache
+        self.name = name
+
+    def get(self, key):
+        entry = self.cache.get((self.name, key))
+        self.cache.incr((self.name, 'misses' if entry is None else 'hits'))
+        return entry
+
+    def put(self, key, entry):
+        self.cache.set((self.name, key), entry)
+        return entry
+
+    def add_recoveries(self, key, tower_key, recoveries):
+        with self.cache.transact():
+            entry = self.cache.get((self.name, key))
+            if entry is None or tower_key in entry.recoveries:
+                return
+            entry.recoveries[tower_key] = recoveries
+            self.cache.set((self.name, key), entry)
+
+    # Sizes are for the whole diskcache, which the caches share
+    def stats(self):
+        return {
+            'hits': self.cache.get((self.name, 'hits'), 0),
+            'misses': self.cache.get((self.name, 'misses'), 0),
+            'bytes': self.cache.volume(),
+            'max_bytes': self.cache.size_limit,
+        }
+
+# Keep the simulation and claim draw caches in a diskcache directory (pip install
+# diskcache) instead of this process's memory, with the same total size, so separate
+# processes running the same models reuse each other's simulations
+def share_simulation_caches(directory):
+    global simulation_cache, claim_draw_cache
+    import diskcache
+    cache = diskcache.Cache(
+        directory, size_limit=simulation_cache.max_bytes + claim_draw_cache.max_bytes,
+        eviction_policy='least-recently-used'
+    )
+    simulation_cache = SharedSimulationCache(cache, 'simulations')
+    claim_draw_cache = SharedSimulationCache(cache, 'claim draws')
+
+# Aggregate recoveries per simulation as a contiguous float64 array. The PAL result
+# already holds them in a NumPy array, so this returns a view of it whenever the
+# dtype and layout allow instead of rebuilding it one Python float at a time.
+def aggregate_recoveries(contract_results):
+    aggregate = contract_results.recoveries.aggregate()
+    return np.ascontiguousarray(getattr(aggregate, 'values', aggregate), dtype=np.float64).reshape(-1)
+
+# Aggregate recoveries of a tower on a chunk of losses; PAL cannot apply a tower to a
+# chunk with no claims, whose recoveries are all zero
+def tower_recoveries(tower, gross_losses):
+    if gross_losses.values.size == 0:
+        return np.zeros(gross_losses.n_sims)
+    return aggregate_recoveries(tower.apply(gross_losses))
+
+# Total recoveries of a single layer (no aggregate terms) for a whole grid of
+# limits and excesses in one pass over the claims. Per claim the layer pays
+# min(x, excess + limit) - min(x, excess), so once the claims are sorted the total of
+# min(x, a) for any attachment point a comes straight from a cumulative sum instead
+# of applying a separate XoLTower for every grid point.
+def sweep_recovery_totals(gross_losses, limits, excesses):
+    limits, excesses = np.broadcast_arrays(
+        np.asarray(limits, dtype=float), np.asarray(excesses, dtype=float)
+    )
+    claims = np.sort(np.asarray(gross_losses.values, dtype=float))
+    cum_claims = np.concatenate(([0.0], np.cumsum(claims)))
+
+    def total_limited(points):
+        n_below = np.searchsorted(claims, points, side='right')
+        return cum_claims[n_below] + points * (claims.size - n_below)
+
+    return total_limited(excesses + limits) - total_limited(excesses)
+
+# Mean recoveries per simulation for the same grid
+def sweep_expected_recoveries(gross_losses, limits, excesses):
+    return sweep_recovery_totals(gross_losses, limits, excesses) / gross_losses.n_sims
+
+# Upper edges of the pie chart ranges. A recovery x falls in range i when
+# edges[i-1] < x <= edges[i]; range 0 is exactly zero and the last range is
+# everything above the top edge
+PIE_BUCKET_EDGES = np.array([
+    0, 10e3, 50e3, 100e3, 1e6, 10e6, 25e6, 50e6, 75e6, 100e6, 250e6, 500e6, 750e6,
+    1e9, 2.5e9, 5e9, 10e9, 25e9, 50e9, 75e9, 100e9, 250e9, 500e9, 750e9, 1e12
+])
+
+# Short money label, e.g. 2500000000 -> "2.5B"
+def format_amount(value):
+    for divisor, suffix in ((1e12, 'T'), (1e9, 'B'), (1e6, 'M'), (1e3, 'K')):
+        if value >= divisor:
+            return f"{value / divisor:g}{suffix}"
+    return f"{value:g}"
+
+def pie_bucket_labels(edges=PIE_BUCKET_EDGES):
+    labels = ["Recoveries = 0"]
+    for low, high in zip(edges[:-1], edges[1:]):
+        labels.append(f"Recoveries = {format_amount(low)}-{format_amount(high)}")
+    labels.append(f"Recoveries > {format_amount(edges[-1])}")
+    return labels
+
+PIE_BUCKET_LABELS = pie_bucket_labels()
+
+# Number of recoveries falling in each pie chart range, in one binary-search pass
+def pie_bucket_counts(recoveries, edges=PIE_BUCKET_EDGES):
+    return np.bincount(np.searchsorted(edges, recoveries, side='left'), minlength=len(edges) + 1)
+
+# An aggregate limit or deductible as PAL takes it: 0, None and NaN (a blank cell in
+# a scenario file) all mean there is none
+def aggregate_term(value):
+    return None if value is None or value == 0 or np.isnan(value) else value
+
+# Single layer XoL tower for the contract parameters entered on the main page
+def build_tower(limit, excess, aggregate_limit, aggregate_deductible, premium):
+    return XoLTower(
+        limit=[limit],
+        excess=[excess],
+        aggregate_limit=[aggregate_term(aggregate_limit)],
+        aggregate_deductible=[aggregate_term(aggregate_deductible)],
+        premium=[premium],
+        reinstatement_cost=[[1, 1, 1], [1, 1, 1], [1, 1, 1], [1, 1, 1], [1, 1, 1]],
+    )
+
+SUMMARY_PERCENTILES = (1, 25, 50, 75, 99)
+
+# Summary statistics and chart data shared by the statistics panel and the figures
+class RecoveryStats:
+    def __init__(self, n, mean, mode, prob_gt_zero, percentiles, min, max, cdf_x, cdf_y,
+                 hist_counts, hist_edges, pie_counts, sample, standard_errors=None):
+        self.n = n
+        self.mean = mean
+        self.mode = mode
+        self.prob_gt_zero = prob_gt_zero
+        self.percentiles = percentiles
+        self.min = min
+        self.max = max
+        self.cdf_x = cdf_x
+        self.cdf_y = cdf_y
+        self.hist_counts = hist_counts
+        self.hist_edges = hist_edges
+        self.pie_counts = pie_counts
+        self.sample = sample
+        # Standard errors of the mean and percentiles ('mean' and percentile keys), when known
+        self.standard_errors = standard_errors
+
+    @property
+    def median(self):
+        return self.percentiles[50]
+
+    # Proportion of recoveries at or below each value, read off the CDF points
+    def cdf_at(self, values):
+        index = np.searchsorted(self.cdf_x, values, side='right') - 1
+        return np.where(index >= 0, self.cdf_y[np.maximum(index, 0)], 0.0)
+
+    # Counts of the positive recoveries on log-spaced bins, for heavy GPD tails
+    def log_histogram(self, n_bins=50):
+        lowest = float(self.cdf_x[min(np.searchsorted(self.cdf_x, 0, side='right'), len(self.cdf_x) - 1)])
+        edges = np.geomspace(lowest, max(float(self.cdf_x[-1]), lowest * (1 + 1e-9)), n_bins + 1)
+        proportions = self.cdf_at(edges)
+        proportions[0] = self.cdf_at(0)
+        return np.rint(np.diff(proportions) * self.n).astype(np.int64), edges
+
+# Statistics for a full array of recoveries from a single sort. The percentiles,
+# min/max, probability of a recovery and the CDF are read off the sorted array, and
+# the 100-bin histogram used for the mode (same edges as np.histogram) is counted
+# with searchsorted on it instead of another pass over the data, as are the pie ranges.
+def compute_recovery_stats(recoveries):
+    sorted_rec = np.sort(recoveries)
+    n = sorted_rec.size
+    low, high = float(sorted_rec[0]), float(sorted_rec[-1])
+
+    hist_edges = np.linspace(low, high, 101) if high > low else np.linspace(low - 0.5, high + 0.5, 101)
+    bin_starts = np.searchsorted(sorted_rec, hist_edges, side='left')
+    bin_starts[-1] = n
+    hist_counts = np.diff(bin_starts)
+    mode_index = int(np.argmax(hist_counts))
+
+    # Linear interpolation between order statistics, as np.percentile does
+    ranks = np.array(SUMMARY_PERCENTILES) / 100 * (n - 1)
+    below = np.floor(ranks).astype(np.int64)
+    above = np.minimum(below + 1, n - 1)
+    values = sorted_rec[below] + (sorted_rec[above] - sorted_rec[below]) * (ranks - below)
+
+    return RecoveryStats(
+        n=n,
+        mean=float(sorted_rec.sum() / n),
+        mode=float((hist_edges[mode_index] + hist_edges[mode_index + 1]) / 2),
+        prob_gt_zero=(n - int(np.searchsorted(sorted_rec, 0, side='right'))) / n,
+        percentiles={q: float(v) for q, v in zip(SUMMARY_PERCENTILES, values)},
+        min=low,
+        max=high,
+        cdf_x=sorted_rec,
+        cdf_y=np.arange(1, n + 1) / n,
+        hist_counts=hist_counts,
+        hist_edges=hist_edges,
+        pie_counts=np.diff(np.searchsorted(sorted_rec, PIE_BUCKET_EDGES, side='right'), prepend=0, append=n),
+        sample=recoveries[:100],
+    )
+
+# Number of simulations per chunk in streaming mode
+STREAM_CHUNK_SIMS = 100_000
+
+# Mergeable summary of recoveries seen so far. Exact for the count, mean, probability
+# of a recovery, min, max and pie buckets; quantiles, the CDF and the histogram come
+# from counts of the positive recoveries in fixed log-spaced buckets, each
+# 1 + 2 * relative_error times as wide as the one before, from smallest to largest.
+# Every recovery is then known to within relative_error however far the tail
+# reaches, and accumulators built with the same buckets merge by adding their counts.
+class RecoveryAccumulator:
+    def __init__(self, relative_error=1e-3, smallest=1e-2, largest=1e16, n_sweep=0, sample_size=100):
+        self.log_smallest = np.log(smallest)
+        self.log_growth = np.log1p(2 * relative_error)
+        n_buckets = int(np.ceil((np.log(largest) - self.log_smallest) / self.log_growth))
+        # Bucket i holds the positive recoveries in (edges[i], edges[i + 1]]; the first
+        # and last also take anything below or above the range
+        self.edges = np.exp(self.log_smallest + np.arange(n_buckets + 1) * self.log_growth)
+        self.n = 0
+        self.total = 0.0
+        self.n_zero = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.counts = np.zeros(n_buckets, dtype=np.int64)
+        self.pie_counts = 0
+        self.sweep_totals = np.zeros(n_sweep)
+        self.sample_size = sample_size
+        self.sample = np.empty(0)
+
+    def update(self, recoveries, sweep_totals=None):
+        if recoveries.size == 0:
+            return
+        self.n += recoveries.size
+        self.total += float(recoveries.sum())
+        self.min = min(self.min, float(recoveries.min()))
+        self.max = max(self.max, float(recoveries.max()))
+        positive = recoveries[recoveries > 0]
+        self.n_zero += recoveries.size - positive.size
+        buckets = np.ceil((np.log(positive) - self.log_smallest) / self.log_growth).astype(np.int64) - 1
+        self.counts += np.bincount(np.clip(buckets, 0, self.counts.size - 1), minlength=self.counts.size)
+        self.pie_counts = self.pie_counts + pie_bucket_counts(recoveries)
+        if sweep_totals is not None:
+            self.sweep_totals += sweep_totals
+        if self.sample.size < self.sample_size:
+            self.sample = np.concatenate((self.sample, recoveries[:self.sample_size - self.sample.size]))
+
+    def merge(self, other):
+        if other.n == 0:
+            return self
+        self.counts = self.counts + other.counts
+        self.n += other.n
+        self.total += other.total
+        self.n_zero += other.n_zero
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.pie_counts = self.pie_counts + other.pie_counts
+        self.sweep_totals = self.sweep_totals + other.sweep_totals
+        if self.sample.size < self.sample_size:
+            self.sample = np.concatenate((self.sample, other.sample[:self.sample_size - self.sample.size]))
+        return self
+
+    # Approximate value at a (fractional) 0-based rank in the sorted recoveries, spread
+    # geometrically across its bucket
+    def _value_at_rank(self, rank):
+        if rank < self.n_zero:
+            return 0.0
+        cum_counts = np.cumsum(self.counts)
+        positive_rank = rank - self.n_zero
+        b = min(int(np.searchsorted(cum_counts, positive_rank, side='right')), self.counts.size - 1)
+        before = cum_counts[b - 1] if b > 0 else 0
+        fraction = (positive_rank - before + 0.5) / max(self.counts[b], 1)
+        return float(np.clip(self.edges[b] * np.exp(fraction * self.log_growth), self.min, self.max))
+
+    def quantile(self, q):
+        rank = q * (self.n - 1)
+        low = self._value_at_rank(np.floor(rank))
+        high = self._value_at_rank(np.ceil(rank))
+        return low + (high - low) * (rank - np.floor(rank))
+
+    # Approximate number of positive recoveries at or below each value, spreading each
+    # bucket's count geometrically across it; exact at and above the max
+    def _positive_count_at(self, values):
+        cum_counts = np.concatenate(([0], np.cumsum(self.counts)))
+        position = (np.log(np.maximum(values, self.edges[0])) - self.log_smallest) / self.log_growth
+        counts = np.interp(position, np.arange(cum_counts.size), cum_counts)
+        return np.where(values >= self.max, cum_counts[-1], counts)
+
+    # Histogram on 100 equal-width bins from min to max (the edges compute_recovery_stats
+    # uses), zeros counted in the first bin
+    def binned(self):
+        if self.max > self.min:
+            edges = np.linspace(self.min, self.max, 101)
+        else:
+            edges = np.linspace(self.min - 0.5, self.max + 0.5, 101)
+        counts = np.diff(np.rint(self._positive_count_at(edges)).astype(np.int64))
+        counts[0] += self.n_zero
+        return counts, edges
+
+    # CDF points at zero and the edges of the buckets in use, ending at the max
+    def cdf(self):
+        used = np.flatnonzero(self.counts)
+        if used.size == 0:
+            return np.zeros(1), np.ones(1)
+        cdf_x = np.minimum(np.concatenate(([0.0], self.edges[used[0]:used[-1] + 2])), self.max)
+        cdf_x[-1] = self.max
+        cdf_y = self.n_zero + np.concatenate(([0, 0], np.cumsum(self.counts[used[0]:used[-1] + 1])))
+        return cdf_x, cdf_y / self.n
+
+    def stats(self):
+        counts, edges = self.binned()
+        mode_index = int(np.argmax(counts))
+        cdf_x, cdf_y = self.cdf()
+        return RecoveryStats(
+            n=self.n,
+            mean=self.total / self.n,
+            mode=float((edges[mode_index] + edges[mode_index + 1]) / 2),
+            prob_gt_zero=(self.n - self.n_zero) / self.n,
+            percentiles={q: self.quantile(q / 100) for q in SUMMARY_PERCENTILES},
+            min=self.min,
+            max=self.max,
+            cdf_x=cdf_x,
+            cdf_y=cdf_y,
+            hist_counts=counts,
+            hist_edges=edges,
+            pie_counts=self.pie_counts,
+            sample=self.sample,
+        )
+
+# Losses capped at the policy limit for n_sims more years of params' loss model,
+# through the same claim draws and GPD inverse CDF as the serial path
+def draw_gross_losses(sim_context, params, n_sims=None):
+    draws = sim_context.draw_claims(params.mean_frequency, n_sims, require_claims=False)
+    return np.minimum(draws.losses(params.gpd_shape, params.gpd_scale, params.gpd_loc), params.policy_limit)
+
+# Simulate n_sims in fixed-size chunks, applying the tower and the effects sweep to
+# each chunk and keeping only the merged summaries, so peak memory does not grow
+# with the number of simulations
+def stream_recoveries(sim_context, params, sweep_limits, sweep_excesses, chunk_size=STREAM_CHUNK_SIMS):
+    accumulator = RecoveryAccumulator(n_sweep=len(sweep_limits))
+    tower = params.tower()
+    remaining = sim_context.n_sims
+    while remaining > 0:
+        n = min(chunk_size, remaining)
+        gross_losses = draw_gross_losses(sim_context, params, n)
+        accumulator.update(
+            tower_recoveries(tower, gross_losses),
+            sweep_recovery_totals(gross_losses, sweep_limits, sweep_excesses)
+        )
+        remaining -= n
+    return accumulator
+
+# Worker processes used by the parallel simulation option. Results are reproducible
+# for a given seed and worker count, since each worker gets its own stream spawned
+# from the seed and a fixed share of the sims.
+SIMULATION_WORKERS = int(os.environ.get('REINSURANCE_WORKERS', os.cpu_count() or 1))
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+def get_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            # spawn rather than fork: the web server process is multi-threaded
+            _process_pool = ProcessPoolExecutor(
+                max_workers=SIMULATION_WORKERS, mp_context=multiprocessing.get_context('spawn')
+            )
+        return _process_pool
+
+# Independent random streams and sim counts for each worker
+def split_simulations(sim_context, n_workers):
+    n_workers = max(1, min(n_workers, sim_context.n_sims))
+    seeds = np.random.SeedSequence(sim_context.seed).spawn(n_workers)
+    sizes = [sim_context.n_sims // n_workers + (i < sim_context.n_sims % n_workers) for i in range(n_workers)]
+    return seeds, sizes
+
+# One worker's share of a parallel run. Plain arrays are returned because PAL
+# variables hold weak references, which cannot be pickled back to the parent.
+def simulate_chunk(seed, n_sims, params):
+    draws = SimulationContext(n_sims, seed).draw_claims(params.mean_frequency, require_claims=False)
+    losses = draws.losses(params.gpd_shape, params.gpd_scale, params.gpd_loc)
+    recoveries = tower_recoveries(params.tower(), np.minimum(losses, params.policy_limit))
+    return losses.sim_index, losses.values, recoveries
+
+# Simulate losses and apply the tower across the process pool, then stitch the
+# workers' results back together in order
+def simulate_parallel(sim_context, params, n_workers=SIMULATION_WORKERS):
+    seeds, sizes = split_simulations(sim_context, n_workers)
+    results = list(get_process_pool().map(simulate_chunk, seeds, sizes, repeat(params)))
+    offsets = np.cumsum([0] + sizes[:-1])
+    sim_index = np.concatenate([index + offset for (index, _, _), offset in zip(results, offsets)])
+    values = np.concatenate([values for _, values, _ in results])
+    recoveries = np.concatenate([recoveries for _, _, recoveries in results])
+    return FreqSevSims(sim_index, values, sim_context.n_sims), recoveries
+
+def stream_chunk(seed, n_sims, params, sweep_limits, sweep_excesses):
+    return stream_recoveries(SimulationContext(n_sims, seed), params, sweep_limits, sweep_excesses)
+
+# Streaming run split across the process pool; each worker streams its own share
+# and the accumulators are merged in worker order
+def stream_recoveries_parallel(sim_context, params, sweep_limits, sweep_excesses, n_workers=SIMULATION_WORKERS):
+    seeds, sizes = split_simulations(sim_context, n_workers)
+    accumulator = RecoveryAccumulator(n_sweep=len(sweep_limits))
+    for result in get_process_pool().map(
+        stream_chunk, seeds, sizes, repeat(params), repeat(sweep_limits), repeat(sweep_excesses)
+    ):
+        accumulator.merge(result)
+    return accumulator
+
+DEFAULT_GPD_SHAPE = 0.33
+DEFAULT_GPD_SCALE = 100000.0
+DEFAULT_GPD_LOC = 1000000.0
+
+# Inputs for one run of the model: the contract, the loss model and how to simulate
+class SimulationParams:
+    def __init__(self, limit, aggregate_limit, policy_limit, excess, aggregate_deductible, premium,
+                 mean_frequency, n_sims, gpd_shape=DEFAULT_GPD_SHAPE, gpd_scale=DEFAULT_GPD_SCALE,
+                 gpd_loc=DEFAULT_GPD_LOC, seed=None, stream=False, parallel=False, method='simulation',
+                 tolerance=None):
+        self.limit = float(limit)
+        # Missing aggregate terms are stored as 0, so every method reads them as none
+        self.aggregate_limit = aggregate_term(float(aggregate_limit)) or 0.0
+        self.policy_limit = float(policy_limit)
+        self.excess = float(excess)
+        self.aggregate_deductible = aggregate_term(float(aggregate_deductible)) or 0.0
+        self.premium = float(premium)
+        self.mean_frequency = float(mean_frequency)
+        self.n_sims = int(n_sims)
+        self.gpd_shape = float(gpd_shape)
+        self.gpd_scale = float(gpd_scale)
+        self.gpd_loc = float(gpd_loc)
+        self.seed = seed
+        self.stream = stream
+        self.parallel = parallel
+        if method not in SIMULATION_METHODS:
+            raise ValueError(f"Unknown method {method!r}; expected one of {', '.join(SIMULATION_METHODS)}.")
+        self.method = method
+        # Only plain Monte Carlo runs can stream in chunks, split across processes or
+        # stop at a tolerance
+        if method != 'simulation' and (stream or parallel or tolerance):
+            raise ValueError(
+                "Streaming, running on all CPU cores and stopping at a tolerance are only available with "
+                "Monte Carlo simulation."
+            )
+        # Relative standard error to stop at; n_sims is then the most simulations to run
+        self.tolerance = float(tolerance) if tolerance else None
+        if self.tolerance is not None and (stream or parallel):
+            raise ValueError("Stopping at a tolerance cannot be combined with streaming or running on all CPU cores.")
+
+    # Contracts with the same loss key can be priced on the same simulated losses
+    @property
+    def loss_key(self):
+        return (self.mean_frequency, self.gpd_shape, self.gpd_scale, self.gpd_loc, self.n_sims, self.seed)
+
+    # Premium does not change recoveries, so it is left out of the key
+    @property
+    def tower_key(self):
+        return (self.policy_limit, self.limit, self.excess, self.aggregate_limit, self.aggregate_deductible)
+
+    def tower(self):
+        return build_tower(self.limit, self.excess, self.aggregate_limit, self.aggregate_deductible, self.premium)
+
+    def severity(self):
+        return distributions.GPD(shape=self.gpd_shape, scale=self.gpd_scale, loc=self.gpd_loc)
+
+    def frequency(self):
+        return distributions.Poisson(mean=self.mean_frequency)
+
+# Output of run_simulation: recovery statistics plus mean recoveries as the limit
+# (at the given excess) and the excess (at the given limit) are varied. converged is
+# None unless the run stopped on a tolerance, then whether it was met.
+class SimulationResults:
+    def __init__(self, params, seed, stats, effect_limits, effect_excesses, mean_rec_by_limit, mean_rec_by_excess,
+                 converged=None):
+        self.params = params
+        self.seed = seed
+        self.stats = stats
+        self.effect_limits = effect_limits
+        self.effect_excesses = effect_excesses
+        self.mean_rec_by_limit = mean_rec_by_limit
+        self.mean_rec_by_excess = mean_rec_by_excess
+        self.converged = converged
+
+# Simulated losses for params from the cache, simulating them on a miss. A parallel
+# miss applies params' tower in the workers too and also returns those recoveries.
+# Batches of a larger run pass require_claims=False, as one may have no claims.
+def cached_losses(params, sim_context, require_claims=True):
+    # Parallel runs draw from one random stream per worker and Sobol runs from scrambled
+    # points, so each is cached separately
+    if params.method == 'sobol':
+        sampler = ('sobol', QMC_REPLICATES)
+    elif params.parallel:
+        sampler = ('parallel', SIMULATION_WORKERS)
+    else:
+        sampler = 'serial'
+    sim_key = (
+        params.mean_frequency, params.gpd_shape, params.gpd_scale, params.gpd_loc,
+        sim_context.n_sims, sim_context.seed, sampler
+    )
+    recoveries = None
+    entry = simulation_cache.get(sim_key)
+    if entry is None and sampler != 'serial' and sampler[0] == 'parallel':
+        losses, recoveries = simulate_parallel(sim_context, params)
+        entry = simulation_cache.put(sim_key, SimulationEntry(losses))
+        simulation_cache.add_recoveries(sim_key, params.tower_key, recoveries)
+    elif entry is None:
+        draws_key = (params.mean_frequency, sim_context.n_sims, sim_context.seed, sampler)
+        draws = claim_draw_cache.get(draws_key)
+        if draws is None and params.method == 'sobol':
+            draws = claim_draw_cache.put(draws_key, sim_context.draw_sobol_claims(params.mean_frequency, QMC_REPLICATES))
+        elif draws is None:
+            draws = claim_draw_cache.put(
+                draws_key, sim_context.draw_claims(params.mean_frequency, require_claims=require_claims)
+            )
+        losses = draws.losses(params.gpd_shape, params.gpd_scale, params.gpd_loc)
+        entry = simulation_cache.put(sim_key, SimulationEntry(losses))
+    return sim_key, entry, recoveries
+
+# Gross losses (capped at the policy limit) and params' recoveries on them, reusing
+# cached losses and recoveries where possible
+def cached_recoveries(params, sim_context, report_stage, require_claims=True):
+    sim_key, entry, recoveries = cached_losses(params, sim_context, require_claims)
+    gross_losses = np.minimum(entry.losses, params.policy_limit)
+    report_stage(1)
+    if recoveries is None:
+        recoveries = entry.recoveries.get(params.tower_key)
+        if recoveries is None:
+            recoveries = tower_recoveries(params.tower(), gross_losses)
+            simulation_cache.add_recoveries(sim_key, params.tower_key, recoveries)
+    return gross_losses, recoveries
+
+# Limits and excesses for the effects sweep around a contract
+def effect_grids(limit):
+    return np.linspace(0, 10_000_000, 11), np.linspace(0, max(limit - 1, 10_000_000), 11)
+
+# Both sweep curves as one grid of (limit, excess) pairs: the limits at the contract's
+# excess, then the excesses at its limit, so the claims are only sorted once
+def sweep_grid(params):
+    limits, excesses = effect_grids(params.limit)
+    return (
+        np.concatenate((limits, np.full_like(excesses, params.limit))),
+        np.concatenate((np.full_like(limits, params.excess), excesses)),
+    )
+
+# SimulationResults with the mean recoveries over sweep_grid split back into the curves
+def sweep_results(params, seed, stats, sweep, converged=None):
+    limits, excesses = effect_grids(params.limit)
+    return SimulationResults(
+        params=params,
+        seed=seed,
+        stats=stats,
+        effect_limits=limits,
+        effect_excesses=excesses,
+        mean_rec_by_limit=sweep[:len(limits)],
+        mean_rec_by_excess=sweep[len(limits):],
+        converged=converged,
+    )
+
+# The report_stage callback of a run, or one that ignores the stages
+def stage_reporter(report_stage):
+    return report_stage or (lambda stage: None)
+
+# Run the model for one set of params. report_stage, if given, is called with the
+# index of each stage as it starts (0: simulating losses, 1: applying the tower,
+# 2: sweeping limit and excess). Raises ValueError when there is nothing to report.
+def run_simulation(params, report_stage=None):
+    if params.method == 'fft':
+        return run_fft(params, report_stage)
+    if params.method == 'importance':
+        return run_importance(params, report_stage)
+    if params.tolerance:
+        return run_adaptive(params, report_stage)
+    report_stage = stage_reporter(report_stage)
+    report_stage(0)
+    sim_context = SimulationContext(params.n_sims, params.seed)
+    sweep_limits, sweep_excesses = sweep_grid(params)
+
+    if params.stream:
+        # Chunked run: only mergeable summaries are kept, so memory stays flat in n_sims
+        stream = stream_recoveries_parallel if params.parallel else stream_recoveries
+        accumulator = stream(sim_context, params, sweep_limits, sweep_excesses)
+        if accumulator.n == 0:
+            raise ValueError("No recoveries generated.")
+        stats = accumulator.stats()
+        sweep = accumulator.sweep_totals / accumulator.n
+    else:
+        gross_losses, recoveries = cached_recoveries(params, sim_context, report_stage)
+        if recoveries.size == 0:
+            raise ValueError("No recoveries generated.")
+
+        report_stage(2)
+        sweep = sweep_expected_recoveries(gross_losses, sweep_limits, sweep_excesses)
+        stats = compute_recovery_stats(recoveries)
+        if params.method == 'sobol':
+            stats.standard_errors = replicate_standard_errors(recoveries, QMC_REPLICATES)
+    return sweep_results(params, sim_context.seed, stats, sweep)
+
+# Most per-claim values held at once when applying several layers together
+LAYER_BLOCK_VALUES = 8_000_000
+
+# Aggregate recoveries per simulation, one row per contract, for several single
+# layers applied to the same claims. Per claim a layer pays
+# min(max(min(x, policy_limit) - excess, 0), limit); the claims of a block of layers
+# are summed per simulation with one bincount, then the aggregate deductible and
+# limit are applied to the totals. This is what XoLTower.apply gives for each
+# contract, without building PAL results for every one. An aggregate limit or
+# deductible of 0, None or NaN means there is none, as in build_tower.
+def layer_recoveries(gross_losses, policy_limits, limits, excesses, aggregate_limits, aggregate_deductibles):
+    claims = np.asarray(gross_losses.values, dtype=float)
+    sim_index = np.asarray(gross_losses.sim_index)
+    n_sims = gross_losses.n_sims
+    policy_limits, limits, excesses, aggregate_limits, aggregate_deductibles = (
+        np.asarray([np.nan if v is None else v for v in values], dtype=float)
+        for values in (policy_limits, limits, excesses, aggregate_limits, aggregate_deductibles)
+    )
+    aggregate_limits = np.where(np.isnan(aggregate_limits) | (aggregate_limits == 0), np.inf, aggregate_limits)
+    aggregate_deductibles = np.nan_to_num(aggregate_deductibles, nan=0.0)
+
+    n_layers = len(limits)
+    totals = np.empty((n_layers, n_sims))
+    block = max(1, LAYER_BLOCK_VALUES // max(claims.size, 1))
+    for start in range(0, n_layers, block):
+        rows = slice(start, min(start + block, n_layers))
+        per_claim = np.minimum(claims, policy_limits[rows, None]) - excesses[rows, None]
+        np.clip(per_claim, 0, limits[rows, None], out=per_claim)
+        offsets = np.arange(per_claim.shape[0])[:, None] * n_sims
+        totals[rows] = np.bincount(
+            (sim_index + offsets).ravel(), weights=per_claim.ravel(), minlength=per_claim.shape[0] * n_sims
+        ).reshape(-1, n_sims)
+    return np.minimum(np.maximum(totals - aggregate_deductibles[:, None], 0), aggregate_limits[:, None])
+
+# Side by side results for several contracts priced on one set of simulated losses
+# (common random numbers). Differences are each contract's recoveries minus the
+# first contract's, per simulation, so the noise shared by both largely cancels.
+class ComparisonResults:
+    def __init__(self, params, seed, recoveries, stats, difference_stats, difference_se):
+        self.params = params
+        self.seed = seed
+        self.recoveries = recoveries
+        self.stats = stats
+        self.difference_stats = difference_stats
+        self.difference_se = difference_se
+
+# Price several contracts that share a loss model on the same simulated losses. The
+# losses are simulated once (or taken from the cache) and all the layers applied in
+# one vectorised pass. Raises ValueError if the contracts need different losses.
+def run_comparison(params_list, report_stage=None):
+    report_stage = stage_reporter(report_stage)
+    if not params_list:
+        raise ValueError("No contracts to compare.")
+    base = params_list[0]
+    if any(params.loss_key != base.loss_key for params in params_list):
+        raise ValueError("Contracts in a comparison must share frequency, GPD parameters, n_sims and seed.")
+
+    report_stage(0)
+    sim_context = SimulationContext(base.n_sims, base.seed)
+    _, entry, _ = cached_losses(base, sim_context)
+
+    report_stage(1)
+    recoveries = layer_recoveries(
+        entry.losses,
+        [params.policy_limit for params in params_list],
+        [params.limit for params in params_list],
+        [params.excess for params in params_list],
+        [params.aggregate_limit for params in params_list],
+        [params.aggregate_deductible for params in params_list],
+    )
+    if recoveries.shape[1] == 0:
+        raise ValueError("No recoveries generated.")
+
+    report_stage(2)
+    differences = recoveries[1:] - recoveries[0]
+    return ComparisonResults(
+        params=params_list,
+        seed=sim_context.seed,
+        recoveries=recoveries,
+        stats=[compute_recovery_stats(row) for row in recoveries],
+        difference_stats=[compute_recovery_stats(row) for row in differences],
+        difference_se=[float(row.std(ddof=1) / np.sqrt(row.size)) if row.size > 1 else float('nan') for row in differences],
+    )
+
+# E[min(X, d)] for X ~ GPD(shape, scale, loc), from the closed form of the integral
+# of the survival function; d can be an array
+def gpd_limited_expected_value(d, shape, scale, loc):
+    t = np.maximum(np.asarray(d, dtype=float) - loc, 0.0)
+    if shape < 0:
+        # Bounded support: nothing is paid above the upper end point
+        t = np.minimum(t, -scale / shape)
+    if abs(shape) <= 1e-10:
+        excess_part = scale * -np.expm1(-t / scale)
+    elif abs(shape - 1) <= 1e-10:
+        excess_part = scale * np.log1p(t / scale)
+    else:
+        excess_part = scale / (1 - shape) * (1 - (1 + shape * t / scale) ** (1 - 1 / shape))
+    return np.minimum(np.asarray(d, dtype=float), loc) + excess_part
+
+def gpd_cdf(x, shape, scale, loc):
+    z = np.maximum(np.asarray(x, dtype=float) - loc, 0.0) / scale
+    if abs(shape) <= 1e-10:
+        return -np.expm1(-z)
+    base = np.maximum(1 + shape * z, 0.0)
+    with np.errstate(divide='ignore'):
+        return np.where(base > 0, 1 - base ** (-1 / shape), 1.0)
+
+# Poisson count that is exceeded with probability below tail
+def poisson_upper_count(mean, tail=1e-12):
+    count, pmf = 0, np.exp(-mean)
+    cdf = pmf
+    while 1 - cdf > tail and count < mean + 50 * np.sqrt(mean) + 50:
+        count += 1
+        pmf *= mean / count
+        cdf += pmf
+    return count
+
+# Recovery distribution without simulation, for a quick preview. The mean with no
+# aggregate terms comes straight from the GPD limited expected value:
+#   mean_frequency * (LEV(min(P, excess + limit)) - LEV(min(P, excess)))
+# With an aggregate deductible or limit, the per-claim layer loss is discretised on
+# a grid of n_points steps (method of rounding) and compounded with the Panjer
+# recursion for Poisson counts, then the aggregate terms are applied to the grid.
+class AnalyticPreview:
+    def __init__(self, expected_per_claim, mean, prob_gt_zero, values, cdf):
+        self.expected_per_claim = expected_per_claim
+        self.mean = mean
+        self.prob_gt_zero = prob_gt_zero
+        self.values = values
+        self.cdf = cdf
+
+    # Smallest grid value whose cumulative probability reaches q/100
+    def percentile(self, q):
+        index = min(int(np.searchsorted(self.cdf, q / 100 - 1e-12, side='left')), len(self.values) - 1)
+        return float(self.values[index])
+
+def analytic_preview(params, n_points=4096):
+    shape, scale, loc = params.gpd_shape, params.gpd_scale, params.gpd_loc
+    lam = params.mean_frequency
+    policy_limit, excess = params.policy_limit, params.excess
+    cap = max(min(params.limit, policy_limit - excess), 0.0)
+    aggregate_limit = params.aggregate_limit or np.inf
+    deductible = params.aggregate_deductible or 0.0
+
+    expected_per_claim = float(
+        gpd_limited_expected_value(min(policy_limit, excess + params.limit), shape, scale, loc)
+        - gpd_limited_expected_value(min(policy_limit, excess), shape, scale, loc)
+    )
+    if lam < 0 or scale <= 0:
+        raise ValueError("Mean frequency must not be negative and GPD scale must be positive.")
+    if cap == 0 or lam == 0:
+        return AnalyticPreview(expected_per_claim, 0.0, 0.0, np.zeros(1), np.ones(1))
+
+    # Per-claim layer loss on a grid with step h
+    max_total = poisson_upper_count(lam) * cap
+    h = min(deductible + aggregate_limit, max_total) / n_points
+    n_claim_points = int(np.ceil(cap / h)) + 1
+    edges = (np.arange(n_claim_points) + 0.5) * h
+    claim_cdf = np.where(edges < cap, gpd_cdf(excess + edges, shape, scale, loc), 1.0)
+    # Only claims that do not reach the layer go to zero, so P(recovery > 0) is kept
+    claim_cdf[0] = gpd_cdf(excess, shape, scale, loc)
+    f = np.diff(claim_cdf, prepend=0.0)
+
+    # Panjer recursion for the compound Poisson total on the grid
+    if lam * (1 - f[0]) > 700:
+        raise ValueError("Mean frequency is too high for the analytic preview.")
+    g = np.zeros(n_points + 1)
+    g[0] = np.exp(-lam * (1 - f[0]))
+    j_f = np.arange(n_claim_points) * f
+    for k in range(1, n_points + 1):
+        j = min(k, n_claim_points - 1)
+        g[k] = lam / k * np.dot(j_f[1:j + 1], g[k - 1::-1][:j])
+    tail = max(1 - g.sum(), 0.0)
+
+    totals = np.arange(n_points + 1) * h
+    recoveries = np.minimum(np.maximum(totals - deductible, 0), aggregate_limit)
+    tail_recovery = aggregate_limit if np.isfinite(aggregate_limit) else recoveries[-1]
+    values = np.append(recoveries, tail_recovery)
+    probabilities = np.append(g, tail)
+    if deductible == 0 and not np.isfinite(aggregate_limit):
+        mean = lam * expected_per_claim
+    else:
+        mean = float(np.dot(values, probabilities))
+    return AnalyticPreview(
+        expected_per_claim=expected_per_claim,
+        mean=mean,
+        prob_gt_zero=float(probabilities[values > 0].sum()),
+        values=values,
+        cdf=np.minimum(np.cumsum(probabilities), 1.0),
+    )
+
+# Grid points for the FFT at a mean frequency: FFT_MIN_CLAIM_STEPS steps for each
+# claim up to the largest likely claim count, rounded up to a power of two, so the
+# step shrinks as the frequency grows, within FFT_POINTS to FFT_MAX_POINTS
+def fft_points(mean_frequency):
+    needed = max(poisson_upper_count(mean_frequency), 1) * FFT_MIN_CLAIM_STEPS + 1
+    return int(min(max(FFT_POINTS, 2 ** int(np.ceil(np.log2(needed)))), FFT_MAX_POINTS))
+
+# Distribution of annual recoveries as (values, probabilities) without sampling.
+# The per-claim layer loss min(max(min(X, policy_limit) - excess, 0), limit) is put on
+# a grid with step h by local moment matching, using the GPD limited expected value,
+# so each claim's mean is exact; the grid ends on the layer cap. Part of the first
+# step's probability stays at zero to keep that mean, so the probability of a
+# recovery is off by less than the chance of a claim within h of the excess. The
+# compound Poisson total on the grid is exp(mean_frequency * (phi - 1)) in Fourier
+# space, where phi is the FFT of the claim distribution. The grid is long enough that
+# the chance of a total beyond it (which would wrap around) is negligible, and totals
+# beyond the 1 - FFT_TAIL quantile are merged into it. The aggregate deductible and
+# limit are then applied to each grid total, O(m log m) overall.
+def fft_recovery_distribution(params, n_points=None):
+    shape, scale, loc = params.gpd_shape, params.gpd_scale, params.gpd_loc
+    lam = params.mean_frequency
+    if lam < 0 or scale <= 0:
+        raise ValueError("Mean frequency must not be negative and GPD scale must be positive.")
+    cap = max(min(params.limit, params.policy_limit - params.excess), 0.0)
+    if cap == 0 or lam == 0:
+        return np.zeros(1), np.ones(1)
+
+    n_points = fft_points(lam) if n_points is None else n_points
+    n_claim_steps = max(1, (n_points - 1) // max(poisson_upper_count(lam), 1))
+    h = cap / n_claim_steps
+    attachment = min(params.policy_limit, params.excess)
+    attachment_lev = gpd_limited_expected_value(attachment, shape, scale, loc)
+    # E[min(Y, j*h)] for j = 0 .. n_claim_steps + 1, flat beyond the cap
+    points = np.minimum(np.arange(n_claim_steps + 2) * h, cap)
+    limited = gpd_limited_expected_value(attachment + points, shape, scale, loc) - attachment_lev
+    f = np.empty(n_claim_steps + 1)
+    f[0] = 1 - limited[1] / h
+    f[1:] = (2 * limited[1:-1] - limited[:-2] - limited[2:]) / h
+    f = np.maximum(f, 0.0)
+
+    phi = np.fft.rfft(f, n_points)
+    g = np.fft.irfft(np.exp(lam * (phi - 1)), n_points)
+    g[g < FFT_PROBABILITY_FLOOR] = 0.0
+    g /= g.sum()
+    last = max(int(np.searchsorted(np.cumsum(g), 1 - FFT_TAIL, side='left')), 1)
+    g[last] += g[last + 1:].sum()
+    g = g[:last + 1]
+
+    aggregate_limit = params.aggregate_limit or np.inf
+    deductible = params.aggregate_deductible or 0.0
+    recoveries = np.minimum(np.maximum(np.arange(g.size) * h - deductible, 0.0), aggregate_limit)
+    # Totals below the deductible or above the limit collapse onto atoms
+    values, index = np.unique(recoveries, return_inverse=True)
+    return values, np.bincount(index, weights=g, minlength=values.size)
+
+# Statistics for a discrete recovery distribution or weighted sample (values sorted,
+# probabilities summing to one), in the same form as for simulated recoveries. Counts
+# (histogram, pie ranges) are expected counts out of n years, so the charts read the
+# same as a simulation of n years; there are no raw recoveries to sample.
+def distribution_recovery_stats(values, probabilities, n):
+    support = probabilities > 0
+    values, probabilities = values[support], probabilities[support]
+    cdf = np.minimum(np.cumsum(probabilities), 1.0)
+    low, high = float(values[0]), float(values[-1])
+
+    hist_edges = np.linspace(low, high, 101) if high > low else np.linspace(low - 0.5, high + 0.5, 101)
+    hist_counts, _ = np.histogram(values, bins=hist_edges, weights=probabilities * n)
+    mode_index = int(np.argmax(hist_counts))
+
+    # Smallest value whose cumulative probability reaches each percentile
+    ranks = np.searchsorted(cdf, np.array(SUMMARY_PERCENTILES) / 100 - 1e-12, side='left')
+    percentiles = values[np.minimum(ranks, values.size - 1)]
+
+    return RecoveryStats(
+        n=n,
+        mean=float(np.dot(values, probabilities)),
+        mode=float((hist_edges[mode_index] + hist_edges[mode_index + 1]) / 2),
+        prob_gt_zero=float(probabilities[values > 0].sum()),
+        percentiles={q: float(v) for q, v in zip(SUMMARY_PERCENTILES, percentiles)},
+        min=low,
+        max=high,
+        cdf_x=values,
+        cdf_y=cdf,
+        hist_counts=hist_counts,
+        hist_edges=hist_edges,
+        pie_counts=np.bincount(
+            np.searchsorted(PIE_BUCKET_EDGES, values, side='left'), weights=probabilities * n,
+            minlength=len(PIE_BUCKET_EDGES) + 1
+        ),
+        sample=np.empty(0),
+    )
+
+# Exact mean per-claim layer recoveries (no aggregate terms) for a grid of limits and
+# excesses, the same quantity the simulated sweep estimates
+def layer_expected_recoveries(params, limits, excesses):
+    shape, scale, loc = params.gpd_shape, params.gpd_scale, params.gpd_loc
+    top = np.minimum(params.policy_limit, excesses + limits)
+    bottom = np.minimum(params.policy_limit, excesses)
+    return params.mean_frequency * (
+        gpd_limited_expected_value(top, shape, scale, loc) - gpd_limited_expected_value(bottom, shape, scale, loc)
+    )
+
+# run_simulation for method 'fft': the same results with no sampling noise. The grid
+# stops at a far quantile, not at the largest recovery, so max is the aggregate limit,
+# or infinite without one (any total is possible).
+def run_fft(params, report_stage=None):
+    report_stage = stage_reporter(report_stage)
+    report_stage(0)
+    values, probabilities = fft_recovery_distribution(params)
+    report_stage(1)
+    stats = distribution_recovery_stats(values, probabilities, params.n_sims)
+    if stats.max > 0:
+        stats.max = params.aggregate_limit or np.inf
+    report_stage(2)
+    return sweep_results(params, None, stats, layer_expected_recoveries(params, *sweep_grid(params)))
+
+# Recoveries as a weighted sample from simulating only the years that reach the layer.
+# Claims at or below the excess never recover, and a year with none above it recovers
+# nothing, so those years are one exact atom at zero with probability 1 - p, where
+# p = 1 - exp(-mean_frequency * P(X > excess)). All n_sims simulations are spent on the
+# other years, each weighted p / n_sims, with only the claims above the excess drawn.
+# Percentiles in the tail then rest on 1 / p times as many recoveries as plain
+# Monte Carlo, with no extra variance from the weights. Returns (values, probabilities).
+def importance_recoveries(params, sim_context):
+    shape, scale, loc = params.gpd_shape, params.gpd_scale, params.gpd_loc
+    threshold_cdf = float(gpd_cdf(params.excess, shape, scale, loc))
+    rate = params.mean_frequency * (1 - threshold_cdf)
+    if rate <= 0 or min(params.limit, params.policy_limit - params.excess) <= 0:
+        return np.zeros(1), np.ones(1)
+    p = -np.expm1(-rate)
+    draws = sim_context.draw_tail_claims(rate, threshold_cdf)
+    gross_losses = draws.losses(shape, scale, loc)
+    gross_losses = FreqSevSims(gross_losses.sim_index, np.minimum(gross_losses.values, params.policy_limit),
+                               gross_losses.n_sims)
+    recoveries = np.sort(aggregate_recoveries(params.tower().apply(gross_losses)))
+    values = np.concatenate(([0.0], recoveries))
+    probabilities = np.concatenate(([1 - p], np.full(recoveries.size, p / recoveries.size)))
+    return values, probabilities
+
+# run_simulation for method 'importance'; the effects sweep uses the exact per-claim
+# layer means, since it varies the excess below the sampling threshold
+def run_importance(params, report_stage=None):
+    report_stage = stage_reporter(report_stage)
+    report_stage(0)
+    if params.mean_frequency < 0 or params.gpd_scale <= 0:
+        raise ValueError("Mean frequency must not be negative and GPD scale must be positive.")
+    sim_context = SimulationContext(params.n_sims, params.seed)
+    values, probabilities = importance_recoveries(params, sim_context)
+    report_stage(1)
+    stats = distribution_recovery_stats(values, probabilities, params.n_sims)
+    report_stage(2)
+    return sweep_results(params, sim_context.seed, stats, layer_expected_recoveries(params, *sweep_grid(params)))
+
+# Sizes of n_replicates blocks of consecutive simulations covering all n_sims
+def replicate_sizes(n_sims, n_replicates):
+    n_replicates = max(1, min(n_replicates, n_sims))
+    return np.full(n_replicates, n_sims // n_replicates) + (np.arange(n_replicates) < n_sims % n_replicates)
+
+# Poisson claim counts from uniforms, by binary search in the cumulative probabilities
+def poisson_invcdf(u, mean):
+    cdf = poisson.cdf(np.arange(int(poisson.ppf(1 - 1e-15, mean)) + 1), mean)
+    return np.minimum(np.searchsorted(cdf, u, side='left'), cdf.size - 1)
+
+# Mean and summary percentiles of one block of recoveries
+def block_estimates(recoveries):
+    estimates = {'mean': float(recoveries.mean())}
+    for q, value in zip(SUMMARY_PERCENTILES, np.percentile(recoveries, SUMMARY_PERCENTILES)):
+        estimates[q] = float(value)
+    return estimates
+
+# Standard errors from the spread of independent block estimates
+def estimate_standard_errors(estimates):
+    return {
+        key: float(np.std([block[key] for block in estimates], ddof=1) / np.sqrt(len(estimates)))
+        for key in estimates[0]
+    }
+
+# Standard errors of the mean and summary percentiles from the spread of their
+# estimates across the replicate blocks of recoveries (in simulation order). With
+# randomised QMC the blocks are independent, which plain Sobol points are not.
+def replicate_standard_errors(recoveries, n_replicates):
+    sizes = replicate_sizes(recoveries.size, n_replicates)
+    if sizes.size < 2:
+        return None
+    return estimate_standard_errors([block_estimates(block) for block in np.split(recoveries, np.cumsum(sizes)[:-1])])
+
+# Standard errors of the mean and summary percentiles of one sample of recoveries,
+# sorted. The mean's is std / sqrt(n). A percentile's comes from the order statistics:
+# the rank of the q-th percentile in n draws is binomial with standard deviation
+# sqrt(n p (1 - p)), so half the gap between the values one standard deviation below
+# and above that rank is its standard error, whatever the distribution.
+def sample_standard_errors(sorted_rec):
+    n = sorted_rec.size
+    errors = {'mean': float(sorted_rec.std(ddof=1) / np.sqrt(n)) if n > 1 else float('inf')}
+    for q in SUMMARY_PERCENTILES:
+        rank, spread = n * q / 100, np.sqrt(n * q / 100 * (1 - q / 100))
+        low = sorted_rec[int(np.clip(np.floor(rank - spread), 0, n - 1))]
+        high = sorted_rec[int(np.clip(np.ceil(rank + spread), 0, n - 1))]
+        errors[q] = float((high - low) / 2)
+    return errors
+
+# Whether the standard errors of the mean and the ADAPTIVE_PERCENTILES are all within
+# tolerance of their estimates (relative). Until some year recovers, every estimate is
+# zero with no spread, which says nothing about precision.
+def within_tolerance(sorted_rec, standard_errors, tolerance):
+    if sorted_rec[-1] <= 0:
+        return False
+    estimates = {'mean': sorted_rec.mean()}
+    estimates.update(zip(ADAPTIVE_PERCENTILES, np.percentile(sorted_rec, ADAPTIVE_PERCENTILES)))
+    return all(standard_errors[key] <= tolerance * abs(estimates[key]) for key in estimates)
+
+# Years per batch of an adaptive run of at most n_sims: at least ADAPTIVE_BATCH_SIMS,
+# and large enough that there are at most ADAPTIVE_MAX_BATCHES convergence checks
+def adaptive_batch_sims(n_sims):
+    return max(ADAPTIVE_BATCH_SIMS, -(-n_sims // ADAPTIVE_MAX_BATCHES))
+
+# run_simulation with a tolerance: simulate batches of years until the standard errors
+# of the mean and the ADAPTIVE_PERCENTILES, from all the years so far, are within
+# params.tolerance of the estimates, or params.n_sims years have been run. Convergence
+# is first checked after ADAPTIVE_MIN_SIMS years (or all n_sims, if fewer), so early
+# noisy estimates cannot stop the run. Each batch has its own seed derived from the
+# run's, so its claims and recoveries are cached like a serial run's. The statistics
+# cover every year simulated, and stats.n is the number of simulations actually used.
+def run_adaptive(params, report_stage=None):
+    report_stage = stage_reporter(report_stage)
+    seed = config.seed if params.seed is None else params.seed
+    sweep_limits, sweep_excesses = sweep_grid(params)
+    batch_sims = adaptive_batch_sims(params.n_sims)
+    min_sims = min(ADAPTIVE_MIN_SIMS, params.n_sims)
+
+    batches = []
+    sorted_rec = np.empty(0)
+    sweep_totals = np.zeros(len(sweep_limits))
+    n_done, converged = 0, False
+    while n_done < params.n_sims and not converged:
+        report_stage(0)
+        batch_context = SimulationContext(min(batch_sims, params.n_sims - n_done), (seed, len(batches)))
+        gross_losses, recoveries = cached_recoveries(params, batch_context, report_stage, require_claims=False)
+        report_stage(2)
+        sweep_totals += sweep_recovery_totals(gross_losses, sweep_limits, sweep_excesses)
+        batches.append(recoveries)
+        # Merging two sorted runs: the stable sort is linear here
+        sorted_rec = np.sort(np.concatenate((sorted_rec, np.sort(recoveries))), kind='stable')
+        n_done += recoveries.size
+        if n_done >= min_sims:
+            converged = within_tolerance(sorted_rec, sample_standard_errors(sorted_rec), params.tolerance)
+
+    if not batches:
+        raise ValueError("No recoveries generated.")
+    stats = compute_recovery_stats(np.concatenate(batches))
+    stats.standard_errors = sample_standard_errors(sorted_rec)
+    return sweep_results(params, seed, stats, sweep_totals / n_done, converged)